@@ -1,27 +1,72 @@
+from datetime import datetime
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
-from models import User, Game, Score, GameState
-from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-    ScoreForms, GameForms, UserForm, UserForms
-from utils import get_by_urlsafe
+import cache
+import leaderboard
+from models import User, UserStats, Game, Score, GameState, \
+    ConcurrentMoveError
+from models import StringMessage, NewGameForm, NewGamesForm, GameForm,\
+    MakeMoveForm, MakeMovesForm, MoveResultForm, MoveResultForms, ScoreForms,\
+    GameForms, UserForm, UserForms, UserStatsForm, RankForm, RankForms
+from instrumentation import instrumented, count
+from utils import get_by_urlsafe, check_complete, fetch_page
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GET_GAME_IF_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        if_version=messages.IntegerField(2),)
 GET_HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
         results=messages.IntegerField(1),)
+GET_HISTORY_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        start=messages.IntegerField(2),
+        end=messages.IntegerField(3),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 NEW_USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1), email=messages.StringField(2))
 USER_REQUEST = endpoints.ResourceContainer(
         user_name=messages.StringField(1),)
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        status=messages.StringField(2),
+        summary=messages.BooleanField(3),
+        page_size=messages.IntegerField(4),
+        cursor=messages.StringField(5),)
+GET_SCORES_REQUEST = endpoints.ResourceContainer(
+        since=messages.StringField(1),
+        page_size=messages.IntegerField(2),
+        cursor=messages.StringField(3),)
+GET_RANKINGS_REQUEST = endpoints.ResourceContainer(
+        limit=messages.IntegerField(1),
+        cursor=messages.StringField(2),)
+USER_NEIGHBORS_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        count=messages.IntegerField(2),)
+
+MAX_PAGE_SIZE = 100
+# Most games created by one new_games call
+MAX_NEW_GAMES = 100
+# Times a move is tried against a game that other requests keep changing
+MOVE_ATTEMPTS = 3
 
-MEMCACHE_AVG_SCORE = 'AVG_SCORE'
+
+def _page_size(request):
+    """Returns the requested page size, checking it is within bounds."""
+    page_size = request.page_size or MAX_PAGE_SIZE
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise endpoints.BadRequestException(
+            'Page size must be between 1 and {}.'.format(MAX_PAGE_SIZE))
+    return page_size
 
 
 @endpoints.api(name='memory_game', version='v1')
@@ -32,58 +77,148 @@ class MemoryGameAPI(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented('api.create_user')
     def create_user(self, request):
         """Creates a new player. Requires email and a unique username."""
-        if User.query(User.name == request.user_name).get():
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A Player with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.key = ndb.Key(User, user.name)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=GET_RANKINGS_REQUEST,
+                      response_message=UserForms,
                       path='user/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented('api.get_user_rankings')
     def get_user_rankings(self, request):
-        """Returns all players ranked by their cumulative points."""
-        users = User.query(User.score > 0).fetch()
-        users = sorted(users, key=lambda x: x.score, reverse=True)
-        return UserForms(items=[user.to_form() for user in users])
+        """Returns a page of players ranked by their cumulative points. Pass
+           the returned 'next_cursor' as 'cursor' to get the next page.
+        """
+        limit = request.limit or 10
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'Limit must be between 1 and {}.'.format(MAX_PAGE_SIZE))
+        rankings, next_cursor, more = leaderboard.get_page(limit,
+                                                           request.cursor)
+        users = ndb.get_multi([ndb.Key(User, name) for name, _ in rankings])
+        User.load_totals(users)
+        return UserForms(items=[user.to_form() for user in users],
+                         next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=RankForm,
+                      path='user/{user_name}/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented('api.get_user_rank')
+    def get_user_rank(self, request):
+        """Returns a player's rank by cumulative points. Players with equal
+           points share a rank.
+        """
+        rank = leaderboard.get_rank(request.user_name)
+        if rank is None:
+            raise endpoints.NotFoundException('Player has no ranking!')
+        score, position, approximate = rank
+        return RankForm(name=request.user_name, score=score, rank=position,
+                        approximate=approximate)
+
+    @endpoints.method(request_message=USER_NEIGHBORS_REQUEST,
+                      response_message=RankForms,
+                      path='user/{user_name}/neighbors',
+                      name='get_user_neighbors',
+                      http_method='GET')
+    @instrumented('api.get_user_neighbors')
+    def get_user_neighbors(self, request):
+        """Returns the player and the N players ranked directly above and
+           below them. If 'N' (count) is not specified, returns 5 each side.
+        """
+        count = request.count or 5
+        if count < 1 or count > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'Count must be between 1 and {}.'.format(MAX_PAGE_SIZE))
+        rank = leaderboard.get_rank(request.user_name)
+        if rank is None:
+            raise endpoints.NotFoundException('Player has no ranking!')
+        neighbors = leaderboard.get_neighbors(request.user_name, count)
+
+        # Rank the neighbors as get_user_rank does: one more than the number
+        # of players with a higher score. The neighbors are consecutive in
+        # the rankings, so those are the players ranked ahead of the first
+        # neighbor and the higher scoring neighbors before each one. If the
+        # player's rank is approximate, so are theirs.
+        _, position, approximate = rank
+        names = [name for name, _ in neighbors]
+        ahead = position - 1 - names.index(request.user_name)
+        items = []
+        for index, (name, score) in enumerate(neighbors):
+            higher = sum(1 for _, other in neighbors[:index] if other > score)
+            items.append(RankForm(name=name, score=score,
+                                  rank=ahead + higher + 1,
+                                  approximate=approximate))
+        return RankForms(items=items)
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented('api.new_game')
     def new_game(self, request):
         """Creates a new game."""
+        user = self._new_game_player(request)
+        game = Game.new_game(request.size, user.key)
+
+        return game.to_form()
+
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented('api.new_games')
+    def new_games(self, request):
+        """Creates a batch of new games of the same size for a player."""
+        if request.count < 1 or request.count > MAX_NEW_GAMES:
+            raise endpoints.BadRequestException(
+                'Count must be between 1 and {}.'.format(MAX_NEW_GAMES))
+        user = self._new_game_player(request)
+        games = Game.new_games(request.size, user.key, request.count)
+        return GameForms(items=[game.to_form() for game in games])
+
+    @staticmethod
+    def _new_game_player(request):
+        """Checks the board size of a new game request and returns the
+        player, raising an error if either is invalid."""
         if request.size < 1:
             raise endpoints.BadRequestException(
                 'Board size must be greater than zero.')
         elif request.size > 500:
             raise endpoints.BadRequestException(
                 'Board size must be 500 or less.')
-        user = User.query(User.name == request.user).get()
+        user = User.get_by_name(request.user)
         if not user:
             raise endpoints.NotFoundException(
                     'A player with that name does not exist!')
-        game = Game.new_game(request.size, user.key)
+        return user
 
-        return game.to_form()
-
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=GET_GAME_IF_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented('api.get_game')
     def get_game(self, request):
         """Returns the specified game in its current state.
            Completed and cancelled games will show all cards revealed.
+           If the game is still at 'if_version', only reports it unchanged.
         """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if game and game.version == request.if_version:
+            form = game.to_form(summary=True)
+            form.not_modified = True
+            return form
         if game:
             hide_solution = True
             if game.status != GameState.Active:
@@ -92,37 +227,55 @@ class MemoryGameAPI(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented('api.get_user_games')
     def get_user_games(self, request):
-        """Returns all player's past and current games, including cancelled."""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of the player's past and current games, including
+           cancelled. Optionally only games with the given status, and only
+           game summaries (without the board).
+        """
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.BadRequestException('Player not found!')
 
-        games = Game.query(ancestor=user.key)
+        games = Game.query(Game.user == user.key)
+        if request.status:
+            if request.status not in GameState.Names:
+                raise endpoints.BadRequestException(
+                    'Status must be one of: {}.'.format(
+                        ', '.join(GameState.Names)))
+            games = games.filter(
+                Game.status == GameState.Names.index(request.status))
+        games, next_cursor = fetch_page(games, _page_size(request),
+                                        request.cursor)
         forms = []
         for game in games:
             hide_solution = True
             if game.status != GameState.Active:
                 hide_solution = False
-            game_form = game.to_form(hide_solution)
+            game_form = game.to_form(hide_solution, summary=request.summary)
             forms.append(game_form)
-        return GameForms(items=forms)
+        return GameForms(items=forms, next_cursor=next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented('api.cancel_game')
     def cancel_game(self, request):
         """Cancels a game. Only active games can be cancelled."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game and (game.status is GameState.Active):
-            game.cancel_game()
+            try:
+                game.cancel_game()
+            except ConcurrentMoveError as error:
+                count('game_conflicts')
+                raise endpoints.ConflictException(error.message)
             return StringMessage(message='Cancelled the game with key: {}.'.
                                  format(request.urlsafe_game_key))
         elif game and (game.status is GameState.Completed):
@@ -131,50 +284,141 @@ class MemoryGameAPI(remote.Service):
             raise endpoints.NotFoundException('Game not found!')
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
-                      response_message=GameForm,
+                      response_message=MoveResultForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented('api.make_move')
     def make_move(self, request):
-        """Makes a move. Returns guessed card values and current board state."""
+        """Makes a move. Returns the guessed card values, whether they match
+           and the game's remaining pairs, score and version. A move retried
+           with the same move_token returns the first result without being
+           made again. If version is given, the move is only made if the game
+           is still at that version.
+        """
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        card1, card2 = request.card1, request.card2
+        for attempt in range(MOVE_ATTEMPTS):
+            if not game:
+                raise endpoints.NotFoundException('Game not found')
+            if request.move_token:
+                result = game.move_result_for_token(request.move_token)
+                if result:
+                    return result
+            if game.status is not GameState.Active:
+                raise endpoints.NotFoundException('Game already over')
+            if request.version is not None and \
+                    request.version != game.version:
+                raise endpoints.ConflictException(
+                    'The game is at version {}.'.format(game.version))
+
+            try:
+                matched = game.make_move(card1, card2, request.move_token)
+                return game.move_result(card1, card2, matched)
+            except ValueError as error:
+                raise endpoints.BadRequestException(error.message)
+            except ConcurrentMoveError:
+                count('game_conflicts')
+                # Try the move against the game the other request saved
+                game = game.key.get(use_cache=False)
+        raise endpoints.ConflictException(
+            'The game is being changed by other requests, try again.')
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MoveResultForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented('api.make_moves')
+    def make_moves(self, request):
+        """Makes a series of moves in order and saves the game once. Stops at
+           the first invalid move or when the game is won. Returns the result
+           of each move attempted and the final game state.
+        """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found')
-        if game.status is GameState.Completed:
-            raise endpoints.NotFoundException('Game already over')
+        if game.status is not GameState.Active:
+            raise endpoints.BadRequestException('Game already over')
 
-        card1, card2 = request.card1, request.card2
-        try:
-            game.make_move(card1, card2)
-            return game.to_form(card1=card1, card2=card2)
-        except ValueError as error:
-            raise endpoints.BadRequestException(error.message)
+        results = []
+        applied = 0
+        for move in request.moves:
+            if check_complete(game.board):
+                break
+            card1, card2 = move.card1, move.card2
+            try:
+                matched = game.apply_move(card1, card2)
+            except ValueError as error:
+                results.append(MoveResultForm(card1=card1, card2=card2,
+                                              error=error.message))
+                break
+            results.append(game.move_result(card1, card2, matched))
+            applied += 1
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+        if applied:
+            try:
+                game.commit_moves()
+            except ConcurrentMoveError as error:
+                count('game_conflicts')
+                raise endpoints.ConflictException(error.message)
+            # The moves were saved together, so they share the saved version,
+            # and the last one applied reports the saved status
+            for result in results[:applied]:
+                result.version = game.version
+            results[applied - 1].status = GameState.Names[game.status]
+        hide_solution = game.status == GameState.Active
+        return MoveResultForms(items=results,
+                               game=game.to_form(hide_solution))
+
+    @endpoints.method(request_message=GET_HISTORY_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented('api.get_game_history')
     def get_game_history(self, request):
-        """Returns the card guessing history of a game."""
+        """Returns the card guessing history of a game. The optional 'start'
+           and 'end' move numbers page through the history of long games.
+        """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found')
-        return StringMessage(message=str(game.history))
+        start = request.start or 0
+        if start < 0 or (request.end is not None and request.end < start):
+            raise endpoints.BadRequestException(
+                'Move range must satisfy 0 <= start <= end.')
+        return StringMessage(message=str(game.get_history(start, request.end)))
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=GET_SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented('api.get_scores')
     def get_scores(self, request):
-        """Returns scores from all completed games."""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Returns a page of scores from all completed games. If 'since'
+           (YYYY-MM-DD) is given, only scores recorded on or after that date,
+           newest first.
+        """
+        scores = Score.query()
+        if request.since:
+            try:
+                since = datetime.strptime(request.since, '%Y-%m-%d').date()
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'Date must be in the format YYYY-MM-DD.')
+            scores = scores.filter(Score.date >= since).order(-Score.date)
+        scores, next_cursor = fetch_page(scores, _page_size(request),
+                                         request.cursor)
+        return Score.to_forms(scores, next_cursor)
 
     @endpoints.method(request_message=GET_HIGH_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/highest',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented('api.get_high_scores')
     def get_high_scores(self, request):
         """Ranks the top N games (player/score) in descending order. If 'N' is
            not specified, returns the top 3 game scores.
@@ -182,37 +426,40 @@ class MemoryGameAPI(remote.Service):
         # Found this nifty pythonic idiom on Stack Overflow (http://tinyurl.com/n3nv8fl)
         results = request.results or 3
         scores = Score.query().order(-Score.size).fetch(results)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return Score.to_forms(scores)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented('api.get_user_scores')
     def get_user_scores(self, request):
         """Returns all of the specified player's scores for completed games."""
 
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A player with that name does not exist!')
         scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
-
-    @staticmethod
-    def _get_average_score():
-        """Gets the cached average score."""
-        return str(memcache.get(MEMCACHE_AVG_SCORE)) or 0
+        return Score.to_forms(scores)
 
-    @staticmethod
-    def cache_average_score():
-        """Populates memcache with the average score across all players."""
-        users = User.query().fetch()
-        if users:
-            count = len(users)
-            total_score = sum([user.score for user in users])
-            average = float(total_score)/count
-            memcache.set(MEMCACHE_AVG_SCORE, str(average))
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserStatsForm,
+                      path='user/{user_name}/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @instrumented('api.get_user_stats')
+    def get_user_stats(self, request):
+        """Returns the player's statistics over their finished games."""
+        stats = cache.get(ndb.Key(UserStats, request.user_name))
+        if not stats:
+            # Players who haven't finished a game yet have no statistics
+            if not User.get_by_name(request.user_name):
+                raise endpoints.NotFoundException(
+                        'A player with that name does not exist!')
+            stats = UserStats(id=request.user_name)
+        return stats.to_form()
 
 
 api = endpoints.api_server([MemoryGameAPI])
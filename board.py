@@ -0,0 +1,115 @@
+import array
+import pickle
+import random
+import struct
+import sys
+from google.appengine.ext import ndb
+
+# Packed boards start with this header: magic, format version, card count
+BOARD_MAGIC = 'MB'
+BOARD_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<2sBH')
+
+
+class Board(object):
+    """The playing board: a row of face-down cards.
+
+    Card values are kept in an array of unsigned shorts indexed by card
+    position, and the cleared state of the cards in a bitmap, so that the
+    largest (500 match) board packs into about 2KB.
+    """
+    def __init__(self, values, cleared=None):
+        self.values = values
+        if cleared is None:
+            cleared = bytearray((len(values) + 7) // 8)
+        self.cleared = cleared
+        cleared_count = sum(bin(byte).count('1') for byte in cleared)
+        self.remaining = (len(values) - cleared_count) // 2
+
+    @classmethod
+    def deal(cls, size):
+        """Returns a shuffled board with a matching pair of each card value."""
+        # Copy and append the values to themselves: each card gets a match
+        values = array.array('H', range(size)) * 2
+        random.shuffle(values)
+        return cls(values)
+
+    @classmethod
+    def from_cards(cls, cards):
+        """Returns a board built from the legacy list of card dicts."""
+        cleared = bytearray((len(cards) + 7) // 8)
+        for index, card in enumerate(cards):
+            if card["cleared"]:
+                cleared[index >> 3] |= 1 << (index & 7)
+        return cls(array.array('H', [card["value"] for card in cards]),
+                   cleared)
+
+    @classmethod
+    def unpack(cls, data):
+        """Returns the board stored in the packed string data."""
+        magic, version, count = _HEADER.unpack_from(data)
+        if magic != BOARD_MAGIC or version != BOARD_FORMAT_VERSION:
+            raise ValueError('Unknown board format')
+        offset = _HEADER.size + 2 * count
+        values = array.array('H')
+        values.fromstring(data[_HEADER.size:offset])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return cls(values, bytearray(data[offset:]))
+
+    def pack(self):
+        """Returns the board packed into a string."""
+        values = self.values
+        if sys.byteorder != 'little':
+            values = array.array('H', values)
+            values.byteswap()
+        return (_HEADER.pack(BOARD_MAGIC, BOARD_FORMAT_VERSION, len(values)) +
+                values.tostring() + str(self.cleared))
+
+    def __len__(self):
+        return len(self.values)
+
+    def value(self, card):
+        """Returns the value of the card at the given position."""
+        return self.values[card]
+
+    def is_cleared(self, card):
+        """Returns True if the card has already been matched."""
+        return bool(self.cleared[card >> 3] & (1 << (card & 7)))
+
+    def clear_pair(self, card1, card2):
+        """Removes a matched pair of cards from the board."""
+        self.cleared[card1 >> 3] |= 1 << (card1 & 7)
+        self.cleared[card2 >> 3] |= 1 << (card2 & 7)
+        self.remaining -= 1
+
+    def to_list(self, hide_solution=False, reveal=()):
+        """Returns the board as a list of card dicts. If hide_solution is set,
+        only the values of the cards listed in reveal are included.
+        """
+        cards = []
+        for index, value in enumerate(self.values):
+            card = {"cleared": self.is_cleared(index)}
+            if not hide_solution or index in reveal:
+                card["value"] = value
+            cards.append(card)
+        return cards
+
+
+class BoardProperty(ndb.BlobProperty):
+    """Stores a Board in its packed form.
+
+    Boards saved by earlier versions as a pickled list of card dicts are
+    converted when read, and written back packed on the game's next put.
+    """
+    def _validate(self, value):
+        if not isinstance(value, Board):
+            raise TypeError('Expected a Board, got {!r}'.format(value))
+
+    def _to_base_type(self, value):
+        return value.pack()
+
+    def _from_base_type(self, value):
+        if value[:len(BOARD_MAGIC)] == BOARD_MAGIC:
+            return Board.unpack(value)
+        return Board.from_cards(pickle.loads(value))
@@ -0,0 +1,138 @@
+"""Bulk export and import of players, games and scores as newline-delimited
+JSON, one entity per line:
+
+    {"kind": "Game", "key": ["Game", 42], "properties": {...}}
+
+Keys and key properties are written as flat key paths, so that an export can
+be imported into another application, such as the local testbed stubs.
+"""
+import base64
+import collections
+import json
+import zlib
+from datetime import datetime
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+from models import User, UserStats, GameRecord, Game, HistorySegment, \
+    Score
+from utils import fetch_page
+
+# Exported kinds, in the order an export writes them
+KINDS = collections.OrderedDict((model.__name__, model) for model in
+                                (User, UserStats, GameRecord, Game,
+                                 HistorySegment, Score))
+# Number of entities in each exported chunk or imported batch
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_value(prop, value):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    value = prop._call_to_base_type(value)
+    if isinstance(prop, ndb.BlobProperty):
+        if prop._compressed:
+            # Written uncompressed, as compression is applied on put
+            value = zlib.decompress(value.z_val)
+        return base64.b64encode(value)
+    if isinstance(prop, ndb.DateTimeProperty):
+        return value.strftime(TIMESTAMP_FORMAT)
+    return value
+
+
+def _decode_value(prop, value):
+    if value is None:
+        return None
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    if isinstance(prop, ndb.BlobProperty):
+        value = base64.b64decode(value)
+    elif isinstance(prop, ndb.DateTimeProperty):
+        value = datetime.strptime(value, TIMESTAMP_FORMAT)
+    return prop._call_from_base_type(value)
+
+
+def entity_to_dict(entity):
+    """Returns a JSON-serializable dict of the entity's key and properties.
+    A player's lifetime totals are written to its stored totals, so that
+    they don't depend on the counters.
+    """
+    properties = {}
+    for prop in entity._properties.itervalues():
+        properties[prop._code_name] = _encode_value(prop,
+                                                    prop._get_value(entity))
+    if isinstance(entity, User):
+        properties['base_games'] = entity.games
+        properties['base_score'] = entity.score
+    return {'kind': entity._get_kind(),
+            'key': list(entity.key.flat()),
+            'properties': properties}
+
+
+def entity_from_dict(data):
+    """Returns the entity of a dict written by entity_to_dict()."""
+    model = KINDS[data['kind']]
+    entity = model(key=ndb.Key(flat=data['key']))
+    for name, value in data['properties'].iteritems():
+        setattr(entity, name, _decode_value(getattr(model, name), value))
+    return entity
+
+
+def export_chunk(kind, cursor=None, limit=EXPORT_BATCH_SIZE):
+    """Returns up to limit entities of the kind as JSON lines, and the
+    urlsafe cursor to export the next chunk from, or None after the last
+    chunk. Only one chunk is held in memory.
+    """
+    entities, next_cursor = fetch_page(KINDS[kind].query(), limit, cursor)
+    if kind == User.__name__:
+        User.load_totals(entities)
+    lines = [json.dumps(entity_to_dict(entity), sort_keys=True)
+             for entity in entities]
+    return lines, next_cursor
+
+
+def _reserve_ids(entities):
+    """Reserves the numeric ids of the root entities, so that ids allocated
+    later, like those of new games, don't collide with them.
+    """
+    highest = {}
+    for entity in entities:
+        key = entity.key
+        if key.parent() is None and isinstance(key.id(), (int, long)):
+            highest[key.kind()] = max(highest.get(key.kind(), 0), key.id())
+    for kind, max_id in highest.iteritems():
+        KINDS[kind].allocate_ids(max=max_id)
+
+
+def _put_batch(entities):
+    # The entities are put as exported, skipping the model hooks: versions
+    # and update times are kept and the entity cache isn't filled
+    _reserve_ids(entities)
+    adapter = ndb.ModelAdapter()
+    datastore.Put([datastore.Entity.FromPb(adapter.entity_to_pb(entity))
+                   for entity in entities])
+
+
+def import_lines(lines, batch_size=IMPORT_BATCH_SIZE):
+    """Imports the entities of an export, given as an iterable of JSON
+    lines, in batch puts of batch_size entities. Returns the number of
+    entities imported of each kind. Only one batch is held in memory.
+    """
+    counts = collections.Counter()
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        entity = entity_from_dict(json.loads(line))
+        counts[entity._get_kind()] += 1
+        batch.append(entity)
+        if len(batch) >= batch_size:
+            _put_batch(batch)
+            batch = []
+    if batch:
+        _put_batch(batch)
+    return counts
@@ -0,0 +1,206 @@
+import collections
+import contextlib
+import threading
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+# Maximum number of entities held in each instance's local cache
+LOCAL_CACHE_SIZE = 1000
+# Entries cached before versions were taken from the entities were under
+# random versions in the 'entities' namespace, and are left there
+MEMCACHE_NAMESPACE = 'entities-2'
+# Seconds entities stay in memcache, which bounds how long an entity stays
+# cached after its update was lost with the request that wrote it
+MEMCACHE_TTL = 10 * 60
+# Attempts to replace an entity's cached version, before dropping it
+VERSION_ATTEMPTS = 3
+
+_lock = threading.Lock()
+# urlsafe key -> (version, encoded entity), least recently used first
+_local = collections.OrderedDict()
+_stats = collections.Counter()
+# Entities put inside a batched_updates() block of the current thread
+_batch = threading.local()
+
+
+class CachedModel(ndb.Model):
+    """Base for models read through the entity cache with get(). Every put
+    stores the entity in the cache under its new version.
+    """
+    # The entity cache keeps its own copy in memcache
+    _use_memcache = False
+
+    # Incremented on every put, so clients can tell if the entity has
+    # changed, and the cache never replaces an entity with an older one
+    version = ndb.IntegerProperty(default=0)
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+    def _post_put_hook(self, future):
+        if ndb.in_transaction():
+            ndb.get_context().call_on_commit(lambda: update(self))
+        else:
+            update(self)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if ndb.in_transaction():
+            ndb.get_context().call_on_commit(lambda: invalidate(key))
+        else:
+            invalidate(key)
+
+
+def _version_key(name):
+    return 'v:' + name
+
+
+def _entity_key(name):
+    return 'e:' + name
+
+
+def _encode(entity):
+    return ndb.ModelAdapter().entity_to_pb(entity).Encode()
+
+
+def _decode(data):
+    return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(data))
+
+
+def _store_local(name, cached):
+    with _lock:
+        _local.pop(name, None)
+        _local[name] = cached
+        while len(_local) > LOCAL_CACHE_SIZE:
+            _local.popitem(last=False)
+
+
+def _count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+
+def get(key):
+    """Returns the entity for the key, or None if no entity exists.
+
+    The current version of the entity is looked up in memcache, and the
+    entity served from the local cache or memcache if either holds that
+    version. Otherwise it is read from the datastore and cached, unless a
+    newer version was cached since.
+    """
+    name = key.urlsafe()
+    version = memcache.get(_version_key(name), namespace=MEMCACHE_NAMESPACE)
+    if version is not None:
+        with _lock:
+            cached = _local.get(name)
+        if cached and cached[0] == version:
+            _count('local_hits')
+            return _decode(cached[1])
+        cached = memcache.get(_entity_key(name), namespace=MEMCACHE_NAMESPACE)
+        if cached and cached[0] == version:
+            _count('memcache_hits')
+            _store_local(name, cached)
+            return _decode(cached[1])
+
+    _count('misses')
+    entity = key.get()
+    if entity is not None:
+        update_multi([entity])
+    return entity
+
+
+def update(entity):
+    """Stores a freshly written entity in the cache under its version."""
+    pending = getattr(_batch, 'entities', None)
+    if pending is not None:
+        pending.append(entity)
+    else:
+        update_multi([entity])
+
+
+def update_multi(entities):
+    """Stores several entities in the cache, each under its version, unless
+    a newer version of it is cached already.
+
+    The cached versions are read and replaced with memcache compare-and-set
+    in batch calls, so that of concurrent updates, which may finish in any
+    order, the newest is kept. An entity whose version can't be replaced in
+    VERSION_ATTEMPTS is dropped from the cache.
+    """
+    client = memcache.Client()
+    pending = dict((entity.key.urlsafe(), entity) for entity in entities)
+    current = {}
+    for _ in range(VERSION_ATTEMPTS):
+        if not pending:
+            break
+        cached = client.get_multi([_version_key(name) for name in pending],
+                                  namespace=MEMCACHE_NAMESPACE, for_cas=True)
+        added, replaced = {}, {}
+        for name, entity in pending.items():
+            version = cached.get(_version_key(name))
+            if version is None:
+                added[_version_key(name)] = entity.version
+            elif version < entity.version:
+                replaced[_version_key(name)] = entity.version
+            else:
+                # Only an entity at the cached version is stored with it
+                if version == entity.version:
+                    current[name] = entity
+                del pending[name]
+        failed = set()
+        if added:
+            failed.update(client.add_multi(
+                added, time=MEMCACHE_TTL, namespace=MEMCACHE_NAMESPACE))
+        if replaced:
+            failed.update(client.cas_multi(
+                replaced, time=MEMCACHE_TTL, namespace=MEMCACHE_NAMESPACE))
+        for name in list(pending):
+            if _version_key(name) not in failed:
+                current[name] = pending.pop(name)
+    for entity in pending.values():
+        invalidate(entity.key)
+
+    updates = dict((name, (entity.version, _encode(entity)))
+                   for name, entity in current.iteritems())
+    failed = set(memcache.set_multi(
+        dict((_entity_key(name), cached)
+             for name, cached in updates.iteritems()),
+        time=MEMCACHE_TTL, namespace=MEMCACHE_NAMESPACE))
+    for name, entity in current.iteritems():
+        if _entity_key(name) in failed:
+            invalidate(entity.key)
+        else:
+            _store_local(name, updates[name])
+
+
+@contextlib.contextmanager
+def batched_updates():
+    """Defers the cache updates of the entities put in the block by this
+    thread to one update_multi() call at its end."""
+    entities = _batch.entities = []
+    try:
+        yield
+    finally:
+        _batch.entities = None
+        if entities:
+            update_multi(entities)
+
+
+def invalidate(key):
+    """Removes the entity for the key from the cache."""
+    name = key.urlsafe()
+    memcache.delete_multi([_version_key(name), _entity_key(name)],
+                          namespace=MEMCACHE_NAMESPACE)
+    with _lock:
+        _local.pop(name, None)
+
+
+def get_stats():
+    """Returns this instance's cache hit and miss counts and size."""
+    with _lock:
+        stats = dict(local_hits=_stats['local_hits'],
+                     memcache_hits=_stats['memcache_hits'],
+                     misses=_stats['misses'],
+                     local_size=len(_local))
+    return stats
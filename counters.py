@@ -0,0 +1,105 @@
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# Number of shards each counter's writes are spread over
+NUM_SHARDS = 10
+MEMCACHE_NAMESPACE = 'counters'
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '{}:{}'.format(name, index))
+            for index in range(NUM_SHARDS)]
+
+
+def get_count(name):
+    """Returns the total of the named counter."""
+    return get_counts([name])[name]
+
+
+def get_counts(names):
+    """Returns a dict of the totals of the named counters. Totals are read
+    from memcache, falling back to summing the shards of any counters missing
+    from it in a single batch get.
+    """
+    totals = memcache.get_multi(names, namespace=MEMCACHE_NAMESPACE)
+    missing = [name for name in names if name not in totals]
+    if missing:
+        keys = []
+        for name in missing:
+            keys.extend(_shard_keys(name))
+        shards = ndb.get_multi(keys)
+        computed = {}
+        for index, name in enumerate(missing):
+            name_shards = shards[index * NUM_SHARDS:(index + 1) * NUM_SHARDS]
+            computed[name] = sum(shard.count for shard in name_shards if shard)
+        memcache.add_multi(computed, namespace=MEMCACHE_NAMESPACE)
+        totals.update(computed)
+    return totals
+
+
+def increment(name, delta=1):
+    """Adds delta (which may be negative) to the named counter."""
+    increment_async(name, delta).get_result()
+
+
+@ndb.tasklet
+def increment_async(name, delta=1):
+    """Adds delta (which may be negative) to the named counter, returning a
+    Future.
+    """
+    yield ndb.transaction_async(lambda: add_to_shard_async(name, delta))
+    yield update_cached_total_async(name, delta)
+
+
+@ndb.tasklet
+def add_to_shard_async(name, delta):
+    """Adds delta to a randomly chosen shard of the named counter in the
+    current transaction, returning a Future, so that the increment can be
+    committed along with other writes. update_cached_total_async() must be
+    called once the transaction commits.
+    """
+    key = random.choice(_shard_keys(name))
+    shard = (yield key.get_async()) or CounterShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
+
+
+@ndb.tasklet
+def update_cached_total_async(name, delta):
+    """Adds delta to the named counter's total cached in memcache, returning
+    a Future."""
+    context = ndb.get_context()
+    if delta >= 0:
+        yield context.memcache_incr(name, delta, namespace=MEMCACHE_NAMESPACE)
+        return
+    # memcache won't decrement below zero, so a total that would go negative
+    # is dropped and recomputed from the shards
+    cached = yield context.memcache_decr(name, -delta,
+                                         namespace=MEMCACHE_NAMESPACE)
+    if cached == 0:
+        yield context.memcache_delete(name, namespace=MEMCACHE_NAMESPACE)
+
+
+@ndb.tasklet
+def drop_cached_totals_async(names):
+    """Drops the named counters' totals cached in memcache, so that they are
+    recomputed from the shards, returning a Future."""
+    context = ndb.get_context()
+    yield [context.memcache_delete(name, namespace=MEMCACHE_NAMESPACE)
+           for name in names]
+
+
+def reset(name, total=0):
+    """Sets the named counter to total. Increments made while it runs may be
+    lost, so it is only meant for rebuilding a counter offline.
+    """
+    shards = [CounterShard(key=key) for key in _shard_keys(name)]
+    shards[0].count = total
+    ndb.put_multi(shards)
+    memcache.set(name, total, namespace=MEMCACHE_NAMESPACE)
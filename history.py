@@ -0,0 +1,30 @@
+import array
+import sys
+
+# Number of moves held in each stored history segment
+MOVES_PER_SEGMENT = 128
+
+
+def pack_moves(moves):
+    """Packs a list of (card1, card2) moves into a string of unsigned shorts."""
+    cards = array.array('H')
+    for card1, card2 in moves:
+        cards.append(card1)
+        cards.append(card2)
+    if sys.byteorder != 'little':
+        cards.byteswap()
+    return cards.tostring()
+
+
+def unpack_moves(data):
+    """Returns the list of (card1, card2) moves packed in the string data."""
+    cards = array.array('H')
+    cards.fromstring(data or '')
+    if sys.byteorder != 'little':
+        cards.byteswap()
+    return zip(cards[::2], cards[1::2])
+
+
+def append_move(data, card1, card2):
+    """Returns the packed string data with one more move appended."""
+    return (data or '') + pack_moves([(card1, card2)])
@@ -0,0 +1,168 @@
+import bisect
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map, memcache
+
+import cache
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# Seconds between flushes of an instance's stats to the log and memcache
+FLUSH_INTERVAL = 60
+MEMCACHE_NAMESPACE = 'stats'
+MEMCACHE_INSTANCES = 'instances'
+# How long an instance's flushed stats are kept after its last flush
+SNAPSHOT_TTL = 60 * 60
+
+# (service, call) -> name of the counter incremented for each API call
+_CALLS = {('datastore_v3', 'Get'): 'datastore_get',
+          ('datastore_v3', 'Put'): 'datastore_put',
+          ('datastore_v3', 'RunQuery'): 'datastore_query',
+          ('datastore_v3', 'Next'): 'datastore_query_next',
+          ('memcache', 'Get'): 'memcache_get',
+          ('memcache', 'Set'): 'memcache_set'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_last_flush = [time.time()]
+_instance_id = os.environ.get('INSTANCE_ID', 'local-{}'.format(os.getpid()))
+
+
+def _counters():
+    """Returns the running API call counters of the current thread."""
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = collections.Counter()
+    return counters
+
+
+def _post_call_hook(service, call, request, response):
+    """Counts each API call, with the entity bytes and memcache hits."""
+    counters = _counters()
+    name = _CALLS.get((service, call))
+    if name:
+        counters[name] += 1
+    if service == 'datastore_v3':
+        if call in ('Get', 'RunQuery', 'Next'):
+            counters['bytes_read'] += response.ByteSize()
+        elif call == 'Put':
+            counters['bytes_written'] += request.ByteSize()
+    elif service == 'memcache' and call == 'Get':
+        counters['memcache_keys'] += request.key_size()
+        counters['memcache_hits'] += response.item_size()
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _post_call_hook)
+
+
+class Histogram(object):
+    """Latency histogram and API call totals of one instrumented operation"""
+    def __init__(self):
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.counters = collections.Counter()
+
+    def add(self, elapsed_ms, counters):
+        self.calls += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed_ms)] += 1
+        self.counters.update(counters)
+
+    def to_dict(self):
+        return {'calls': self.calls,
+                'mean_ms': round(self.total_ms / self.calls, 3)
+                if self.calls else None,
+                'max_ms': round(self.max_ms, 3),
+                'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] +
+                                    ['inf'], self.buckets)),
+                'counters': dict(self.counters)}
+
+
+def count(name, delta=1):
+    """Adds delta to a counter of the current thread, which is recorded along
+    with the API call counts of the instrumented operations running in it.
+    """
+    _counters()[name] += delta
+
+
+def instrumented(name):
+    """Decorator recording the wall time and API calls of each call of the
+    function in the instance's histogram for the named operation.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            before = _counters().copy()
+            started = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed_ms = (time.time() - started) * 1000
+                _record(name, elapsed_ms, _counters() - before)
+        return wrapper
+    return decorator
+
+
+def _record(name, elapsed_ms, counters):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(elapsed_ms, counters)
+        due = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+        if due:
+            _last_flush[0] = time.time()
+    if due:
+        flush()
+
+
+def get_snapshot():
+    """Returns this instance's stats since it started."""
+    with _lock:
+        operations = dict((name, histogram.to_dict())
+                          for name, histogram in _histograms.iteritems())
+    return {'instance': _instance_id,
+            'time': time.time(),
+            'operations': operations,
+            'cache': cache.get_stats()}
+
+
+def flush():
+    """Logs this instance's stats, one structured line per operation, and
+    publishes them to memcache for the admin stats page.
+    """
+    snapshot = get_snapshot()
+    for name, stats in sorted(snapshot['operations'].items()):
+        logging.info(json.dumps({'stats': name,
+                                 'instance': _instance_id,
+                                 'calls': stats['calls'],
+                                 'mean_ms': stats['mean_ms'],
+                                 'max_ms': stats['max_ms'],
+                                 'counters': stats['counters']},
+                                sort_keys=True))
+    memcache.set(_instance_id, snapshot, time=SNAPSHOT_TTL,
+                 namespace=MEMCACHE_NAMESPACE)
+    instances = memcache.get(MEMCACHE_INSTANCES,
+                             namespace=MEMCACHE_NAMESPACE) or []
+    if _instance_id not in instances:
+        memcache.set(MEMCACHE_INSTANCES, (instances + [_instance_id])[-100:],
+                     namespace=MEMCACHE_NAMESPACE)
+
+
+def get_all_snapshots():
+    """Returns the most recently flushed stats of every instance, keyed by
+    instance id."""
+    flush()
+    instances = memcache.get(MEMCACHE_INSTANCES,
+                             namespace=MEMCACHE_NAMESPACE) or []
+    return memcache.get_multi(instances, namespace=MEMCACHE_NAMESPACE)
@@ -0,0 +1,165 @@
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from utils import fetch_page
+
+# Number of leading players whose rankings are cached in memcache
+TOP_K = 100
+MEMCACHE_TOP_K = 'LEADERBOARD_TOP'
+# Players ranked ahead of a player are counted up to this many
+MAX_COUNTED_AHEAD = 1000
+
+
+class Ranking(ndb.Model):
+    """A player's lifetime score, indexed for ranking. Keyed by player name."""
+    score = ndb.IntegerProperty(default=0)
+
+
+@ndb.tasklet
+def add_points_async(user_key, points):
+    """Adds points to the player's ranking in the current transaction,
+    returning a Future for the ranking, or for None if the player has no
+    ranking yet. The ranking must then be seeded with seed_async() once the
+    transaction commits.
+    """
+    ranking = yield ndb.Key(Ranking, user_key.id()).get_async()
+    if ranking is not None:
+        ranking.score += points
+        yield ranking.put_async()
+    raise ndb.Return(ranking)
+
+
+@ndb.tasklet
+def seed_async(user_key):
+    """Creates the player's ranking from their lifetime score, which must
+    already hold the points being ranked, returning a Future for it.
+    """
+    key = ndb.Key(Ranking, user_key.id())
+    seed = yield _lifetime_score_async(user_key)
+
+    @ndb.tasklet
+    def txn():
+        ranking = yield key.get_async()
+        if ranking is not None:
+            # Another update created the ranking after the seed was read,
+            # possibly with these points already in its own seed
+            raise ndb.Return(None)
+        ranking = Ranking(key=key, score=seed)
+        yield ranking.put_async()
+        raise ndb.Return(ranking)
+    ranking = yield ndb.transaction_async(txn)
+    if ranking is None:
+        # The ranking exists now, so the player's score read from here on
+        # holds every update that found it missing
+        seed = yield _lifetime_score_async(user_key)
+
+        @ndb.tasklet
+        def reseed():
+            ranking = yield key.get_async()
+            ranking.score = seed
+            yield ranking.put_async()
+            raise ndb.Return(ranking)
+        ranking = yield ndb.transaction_async(reseed)
+    raise ndb.Return(ranking)
+
+
+@ndb.tasklet
+def uncache_top_async(ranking):
+    """Drops the cached top players if the updated ranking may now be among
+    them, returning a Future."""
+    context = ndb.get_context()
+    top = yield context.memcache_get(MEMCACHE_TOP_K)
+    if top is not None and (len(top) < TOP_K or
+                            ranking.score >= top[-1][1] or
+                            any(name == ranking.key.id()
+                                for name, _, _ in top)):
+        yield context.memcache_delete(MEMCACHE_TOP_K)
+
+
+@ndb.tasklet
+def _lifetime_score_async(user_key):
+    """Returns the player's lifetime score, which already includes the new
+    points, as a Future."""
+    user = yield user_key.get_async(use_cache=False)
+    raise ndb.Return(user.score)
+
+
+def set_scores(scores):
+    """Overwrites the rankings of several players from a dict of their
+    lifetime scores keyed by player name.
+    """
+    ndb.put_multi([Ranking(id=name, score=score)
+                   for name, score in scores.iteritems()])
+    memcache.delete(MEMCACHE_TOP_K)
+
+
+def _ranked_query():
+    return Ranking.query(Ranking.score > 0).order(-Ranking.score)
+
+
+def _get_top():
+    """Returns the cached top players as (name, score, cursor) tuples, where
+    cursor is the urlsafe query cursor following that player.
+    """
+    top = memcache.get(MEMCACHE_TOP_K)
+    if top is None:
+        top = []
+        results = _ranked_query().iter(limit=TOP_K, produce_cursors=True)
+        for ranking in results:
+            top.append((ranking.key.id(), ranking.score,
+                        results.cursor_after().urlsafe()))
+        memcache.add(MEMCACHE_TOP_K, top)
+    return top
+
+
+def get_page(limit, cursor=None):
+    """Returns a page of (name, score) rankings in descending order of score,
+    the urlsafe cursor for the next page and whether there are more. Pages
+    within the top players are served from memcache. Raises
+    BadRequestException if the cursor is malformed.
+    """
+    if not cursor and limit <= TOP_K:
+        top = _get_top()
+        if limit < len(top) or len(top) < TOP_K:
+            page = top[:limit]
+            more = limit < len(top)
+            next_cursor = page[-1][2] if page and more else None
+            return [(name, score) for name, score, _ in page], \
+                next_cursor, more
+
+    rankings, next_cursor = fetch_page(_ranked_query(), limit, cursor)
+    return [(ranking.key.id(), ranking.score) for ranking in rankings], \
+        next_cursor, next_cursor is not None
+
+
+def get_rank(name):
+    """Returns the player's score, 1-based rank and whether the rank is
+    approximate, or None if the player has no ranking. Players with equal
+    scores share a rank.
+
+    Counting the players ahead reads an index entry for each, so at most
+    MAX_COUNTED_AHEAD are counted. A player with more ahead is given the rank
+    after them, which is marked approximate: the true rank is lower.
+    """
+    ranking = Ranking.get_by_id(name)
+    if ranking is None:
+        return None
+    ahead = Ranking.query(Ranking.score > ranking.score).count(
+        limit=MAX_COUNTED_AHEAD)
+    return ranking.score, ahead + 1, ahead >= MAX_COUNTED_AHEAD
+
+
+def get_neighbors(name, count):
+    """Returns up to count players ranked directly above and below the
+    player, along with the player, as (name, score) tuples in descending
+    order of score.
+    """
+    ranking = Ranking.get_by_id(name)
+    if ranking is None:
+        return []
+    above = Ranking.query(Ranking.score > ranking.score).\
+        order(Ranking.score).fetch(count)
+    below = Ranking.query(Ranking.score <= ranking.score).\
+        order(-Ranking.score).fetch(count + 1)
+    below = [other for other in below if other.key != ranking.key][:count]
+    neighbors = list(reversed(above)) + [ranking] + below
+    return [(other.key.id(), other.score) for other in neighbors]
@@ -14,51 +14,331 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
+import time
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import MemoryGameAPI
+import bulk
+import instrumentation
+import leaderboard
+import models
+from datetime import datetime, timedelta
+from protorpc import messages
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from utils import get_by_urlsafe
-from models import User, Game, GameState
+from models import User, UserStats, Game, GameRecord, GameState, \
+    ConcurrentMoveError
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Number of players handled by each challenge email task
+CHALLENGE_BATCH_SIZE = 100
+# Number of games examined by each game migration task
+MIGRATION_BATCH_SIZE = 100
+# Number of players whose statistics each rebuild task recomputes
+STATS_BATCH_SIZE = 20
+# How long the progress of a challenge email run is kept, in seconds
+CHALLENGE_RUN_TTL = 24 * 60 * 60
+# Active games without a move for this many days are cancelled by the reaper
+STALE_GAME_DAYS = 30
+# Number of games handled by each reaper or archiver task
+REAPER_BATCH_SIZE = 100
 
 
 class SendChallengeEmail(webapp2.RequestHandler):
     def get(self):
         """Send a challenge email to each player whose score is less than the
         global average. Email body also includes a count of active games and
-        their urlsafe keys. Called every hour using a cron job"""
-        users = User.query()
-
-        for user in users:
-            subject = 'Is your memory better than average?'
-            avg = int(float(MemoryGameAPI._get_average_score()))
-            if (user.score < avg):
-                diff = avg - user.score
-                body = 'Greetings {}, Your current Memory Game score is: {}. '
-                'It is {} less than the average score of {}. Keep going!'.\
-                    format(diff, avg)
-
-                games = Game.query(Game.user == user.key).\
-                    filter(Game.status == GameState.Active)
-                if games.count() > 0:
-                    active_games = 'You have {} games in progress. Their' \
-                                   ' keys are: {}'.\
-                                   format(user.name, games.count(), ', '.
-                                          join(game.key.urlsafe() for game in games))
-                    body += active_games
-                logging.debug(body)
-                mail.send_mail('noreply@{}.appspotmail.com'.
-                               format(app_identity.get_application_id()),
-                               user.email, subject, body)
-
-
-class UpdateAverageScore(webapp2.RequestHandler):
+        their urlsafe keys. Called every day using a cron job. The players are
+        processed in batches of task queue tasks, each continuing from the
+        query cursor where the previous one stopped."""
+        run_id = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        avg = int(User.average_score())
+        _enqueue_challenge_batch(run_id, avg, 0, None, time.time())
+        logging.info('Started challenge email run %s (average score %d)',
+                     run_id, avg)
+
+
+def _enqueue_challenge_batch(run_id, avg, batch, cursor, started):
+    """Enqueues a batch of the challenge email run. Tasks are named after the
+    run and batch, so a retried batch doesn't enqueue its successor twice."""
+    try:
+        taskqueue.add(url='/tasks/send_challenge_batch',
+                      name='challenge-{}-{}'.format(run_id, batch),
+                      params={'run_id': run_id,
+                              'avg': avg,
+                              'batch': batch,
+                              'cursor': cursor or '',
+                              'started': started})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class SendChallengeEmailBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send the challenge emails to one batch of players and enqueue the
+        next batch. A batch whose emails were all sent is skipped if retried.
+        """
+        run_id = self.request.get('run_id')
+        avg = int(self.request.get('avg'))
+        batch = int(self.request.get('batch'))
+        started = float(self.request.get('started'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+
+        users, next_cursor, more = User.query().fetch_page(
+            CHALLENGE_BATCH_SIZE, start_cursor=cursor)
+        if more and next_cursor:
+            _enqueue_challenge_batch(run_id, avg, batch + 1,
+                                     next_cursor.urlsafe(), started)
+
+        done_key = 'challenge-{}-{}'.format(run_id, batch)
+        if memcache.get(done_key):
+            return
+
+        # Look up the active games of the players below average in parallel
+        scanned = batch * CHALLENGE_BATCH_SIZE + len(users)
+        User.load_totals(users)
+        users = [user for user in users if user.score < avg]
+        futures = [Game.query(Game.user == user.key,
+                              Game.status == GameState.Active).
+                   fetch_async(keys_only=True) for user in users]
+
+        sender = 'noreply@{}.appspotmail.com'.format(
+            app_identity.get_application_id())
+        subject = 'Is your memory better than average?'
+        for user, future in zip(users, futures):
+            diff = avg - user.score
+            body = 'Greetings {}, Your current Memory Game score is: {}. ' \
+                   'It is {} less than the average score of {}. ' \
+                   'Keep going!'.format(user.name, user.score, diff, avg)
+            game_keys = future.get_result()
+            if game_keys:
+                body += ' You have {} games in progress. Their keys are: ' \
+                        '{}'.format(len(game_keys),
+                                    ', '.join(key.urlsafe()
+                                              for key in game_keys))
+            logging.debug(body)
+            mail.EmailMessage(sender=sender, to=user.email, subject=subject,
+                              body=body).send()
+        memcache.set(done_key, True, time=CHALLENGE_RUN_TTL)
+
+        # Report the progress of the run
+        progress_key = 'challenge-progress-{}'.format(run_id)
+        memcache.add(progress_key, 0, time=CHALLENGE_RUN_TTL)
+        sent = memcache.incr(progress_key, len(users)) or 0
+        elapsed = time.time() - started
+        logging.info(json.dumps({'job': 'send_challenge',
+                                 'run_id': run_id,
+                                 'batch': batch,
+                                 'players_scanned': scanned,
+                                 'emails_sent': sent,
+                                 'finished': not more,
+                                 'elapsed_seconds': round(elapsed, 1),
+                                 'players_per_second':
+                                     round(scanned / elapsed, 2)
+                                     if elapsed else None}))
+
+
+class MigrateGames(webapp2.RequestHandler):
+    def get(self):
+        """Starts moving the games stored as children of their User to root
+        entities, in task queue batches."""
+        taskqueue.add(url='/tasks/migrate_games')
+        self.response.set_status(202)
+
+    def post(self):
+        """Moves one batch of child games to root entities and enqueues the
+        next batch."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        child_keys = [key for key in keys if key.parent()]
+        if child_keys:
+            first, _ = Game.allocate_ids(size=len(child_keys))
+            for offset, key in enumerate(child_keys):
+                Game.move_to_root(key, first + offset)
+        logging.info('Moved %d games to root entities', len(child_keys))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class ReapGames(webapp2.RequestHandler):
+    def get(self):
+        """Cancels active games idle for more than STALE_GAME_DAYS (or the
+        'days' parameter) and then archives the finished games, in task queue
+        batches. Called every day using a cron job."""
+        days = int(self.request.get('days') or STALE_GAME_DAYS)
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        taskqueue.add(url='/tasks/reap_games',
+                      params={'cutoff': cutoff.strftime(TIMESTAMP_FORMAT)})
+        self.response.set_status(202)
+
+
+class ReapGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Cancels one batch of idle games and enqueues the next batch. Once
+        all are cancelled, starts archiving the finished games."""
+        cutoff = datetime.strptime(self.request.get('cutoff'),
+                                   TIMESTAMP_FORMAT)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            Game.status == GameState.Active, Game.updated < cutoff).\
+            fetch_page(REAPER_BATCH_SIZE, start_cursor=cursor)
+        cancelled = 0
+        for game in games:
+            try:
+                game.cancel_game()
+                cancelled += 1
+            except ConcurrentMoveError:
+                # Played since it was queried, so no longer idle
+                pass
+        logging.info('Cancelled %d games idle since %s', cancelled, cutoff)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/reap_games',
+                          params={'cutoff': self.request.get('cutoff'),
+                                  'cursor': next_cursor.urlsafe()})
+        else:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'status': GameState.Completed})
+
+
+class ArchiveGamesBatch(webapp2.RequestHandler):
+    def post(self):
+        """Archives one batch of the finished games with the given status and
+        enqueues the next batch, moving on from completed to cancelled
+        games."""
+        status = int(self.request.get('status'))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            Game.archived == False, Game.status == status).\
+            fetch_page(REAPER_BATCH_SIZE, start_cursor=cursor)
+        for game in games:
+            game.archive()
+        logging.info('Archived %d %s games', len(games),
+                     GameState.Names[status])
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'status': status,
+                                  'cursor': next_cursor.urlsafe()})
+        elif status == GameState.Completed:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'status': GameState.Cancelled})
+
+
+class RebuildUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Starts recomputing every player's statistics from their finished
+        games, in task queue batches."""
+        taskqueue.add(url='/tasks/rebuild_user_stats')
+        self.response.set_status(202)
+
+    def post(self):
+        """Recomputes the statistics of one batch of players and enqueues
+        the next batch."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        keys, next_cursor, more = User.query().fetch_page(
+            STATS_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for key in keys:
+            UserStats.rebuild(key)
+        logging.info('Rebuilt the statistics of %d players', len(keys))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rebuild_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class RebuildScoreAggregates(webapp2.RequestHandler):
+    def get(self):
+        """Rebuilds the global score aggregates from every player's score."""
+        User.rebuild_score_aggregates()
+        self.response.set_status(204)
+
+
+class Stats(webapp2.RequestHandler):
     def get(self):
-        """Updates average player score in memcache."""
-        MemoryGameAPI.cache_average_score()
+        """Reports the latency histograms, API call counts and entity cache
+        hit rates of each instance, as last flushed to memcache."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.get_all_snapshots(),
+                                       indent=2, sort_keys=True))
+
+
+class ExportEntities(webapp2.RequestHandler):
+    def get(self):
+        """Writes one chunk of the entities of a kind as newline-delimited
+        JSON. The X-Next-Cursor header holds the 'cursor' parameter to pass
+        to export the next chunk, and is left out after the last chunk. A
+        chunk holds at most 'limit' entities, and no more than
+        bulk.EXPORT_BATCH_SIZE, so that it fits in a request."""
+        kind = self.request.get('kind')
+        if kind not in bulk.KINDS:
+            self.abort(400, 'kind must be one of {}'.format(
+                ', '.join(bulk.KINDS)))
+        try:
+            limit = int(self.request.get('limit') or bulk.EXPORT_BATCH_SIZE)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            self.abort(400, 'limit must be a positive number')
+        limit = min(limit, bulk.EXPORT_BATCH_SIZE)
+        lines, next_cursor = bulk.export_chunk(
+            kind, self.request.get('cursor') or None, limit)
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        if next_cursor:
+            self.response.headers['X-Next-Cursor'] = next_cursor
+        for line in lines:
+            self.response.write(line + '\n')
+
+
+class ImportEntities(webapp2.RequestHandler):
+    def post(self):
+        """Imports the entities of a chunk of an export, posted as
+        newline-delimited JSON, and reports the number of each kind."""
+        counts = bulk.import_lines(self.request.body.splitlines())
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(counts, sort_keys=True))
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Loads the API and primes the shared caches before a new instance
+        serves traffic, so its first requests don't pay for them. Called by
+        App Engine when it starts an instance."""
+        # Loads the endpoints server, which the cron and task handlers don't
+        import api
+        for value in vars(models).values():
+            if isinstance(value, type) and issubclass(value, messages.Message):
+                value.definition_name()
+        User.average_score()
+        leaderboard.get_page(leaderboard.TOP_K)
         self.response.set_status(204)
 
 
+class CreditGame(webapp2.RequestHandler):
+    def post(self):
+        """Credits the player with a finished game's points and adds the game
+        to their statistics, and sends them a congratulations email if they
+        completed it. Enqueued with the save that finishes the game; a retry
+        of a game already credited has no effect."""
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        game_key = ndb.Key(urlsafe=self.request.get('game_key'))
+        record = GameRecord(key=GameRecord.key_for(user_key, game_key),
+                            status=int(self.request.get('status')),
+                            moves=int(self.request.get('moves')),
+                            score=int(self.request.get('score')),
+                            size=int(self.request.get('size')))
+        tasks = []
+        if record.status == GameState.Completed:
+            # Send congratulations mail with total score
+            tasks.append(taskqueue.Task(
+                url='/tasks/send_congrats_email',
+                params={'user_key': user_key.urlsafe(),
+                        'game_key': game_key.urlsafe()}))
+        UserStats.record_game(record, int(self.request.get('points')),
+                              int(self.request.get('games')), tasks)
+
+
 class SendCongratsEmail(webapp2.RequestHandler):
     def post(self):
         """Send email to the winning player comparing their score to average."""
@@ -69,7 +349,7 @@ class SendCongratsEmail(webapp2.RequestHandler):
                'Your current score is now {}. The average score is {}. '\
                'Keep it up!'.format(user.name, game.key.urlsafe(),
                                     user.score,
-                                    MemoryGameAPI._get_average_score())
+                                    User.average_score())
         logging.debug(body)
         mail.send_mail('noreply@{}.appspotmail.com'.
                        format(app_identity.get_application_id()), user.email,
@@ -77,7 +357,20 @@ class SendCongratsEmail(webapp2.RequestHandler):
 
 
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
+    ('/tasks/credit_game', CreditGame),
     ('/tasks/send_congrats_email', SendCongratsEmail),
-    ('/crons/cache_average_score', UpdateAverageScore),
-    ('/crons/send_challenge', SendChallengeEmail)
+    ('/admin/rebuild_score_aggregates', RebuildScoreAggregates),
+    ('/admin/stats', Stats),
+    ('/admin/export', ExportEntities),
+    ('/admin/import', ImportEntities),
+    ('/admin/migrate_games', MigrateGames),
+    ('/tasks/migrate_games', MigrateGames),
+    ('/admin/rebuild_user_stats', RebuildUserStats),
+    ('/tasks/rebuild_user_stats', RebuildUserStats),
+    ('/crons/reap_games', ReapGames),
+    ('/tasks/reap_games', ReapGamesBatch),
+    ('/tasks/archive_games', ArchiveGamesBatch),
+    ('/crons/send_challenge', SendChallengeEmail),
+    ('/tasks/send_challenge_batch', SendChallengeEmailBatch)
 ], debug=True)
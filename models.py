@@ -1,17 +1,176 @@
 import math
-import random
-from datetime import date
-from protorpc import messages
+from datetime import date, datetime
+from protorpc import messages, protojson
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+import cache
+import counters
+import leaderboard
+from board import Board, BoardProperty
+from instrumentation import instrumented
+from history import MOVES_PER_SEGMENT, append_move, pack_moves, \
+    unpack_moves
 from utils import check_complete
 
-class User(ndb.Model):
-    """User profile"""
+# Global aggregates, maintained as scores change, for the average score
+TOTAL_SCORE_COUNTER = 'total-score'
+USER_COUNT_COUNTER = 'user-count'
+# Number of latest move tokens whose results each game keeps for retries
+MOVE_TOKENS_KEPT = 16
+# Number of games recorded in each batch when rebuilding a player's stats
+RECORD_BATCH_SIZE = 100
+
+
+class ConcurrentMoveError(Exception):
+    """Raised when a game is saved by another request between being read
+    and saved."""
+
+
+class User(cache.CachedModel):
+    """User profile, keyed by name"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
-    games = ndb.IntegerProperty(default=0)
-    score = ndb.IntegerProperty(default=0)
+    # Lifetime totals are kept in sharded counters so that concurrent games
+    # don't all write to the User. These hold the totals recorded before.
+    base_games = ndb.IntegerProperty('games', default=0)
+    base_score = ndb.IntegerProperty('score', default=0)
+
+    @property
+    def games(self):
+        """Lifetime total of completed games"""
+        return self.base_games + self._totals()[0]
+
+    @property
+    def score(self):
+        """Lifetime total of points scored"""
+        return self.base_score + self._totals()[1]
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the given name, or None. Users are keyed by
+        name, so this is a strongly consistent get through the entity cache.
+        """
+        return cache.get(ndb.Key(cls, name))
+
+    @classmethod
+    def create(cls, name, email):
+        """Creates and returns a new User, or returns None if a User with
+        that name already exists. The check and the insert share a
+        transaction, so concurrent requests can't both create the player.
+        """
+        @ndb.transactional
+        def txn():
+            key = ndb.Key(cls, name)
+            if key.get():
+                return None
+            user = cls(key=key, name=name, email=email)
+            user.put()
+            return user
+        user = txn()
+        if user:
+            counters.increment(USER_COUNT_COUNTER)
+        return user
+
+    def _totals(self):
+        if not hasattr(self, '_counter_totals'):
+            User.load_totals([self])
+        return self._counter_totals
+
+    @staticmethod
+    def games_counter(user_key):
+        return 'user-games:{}'.format(user_key.id())
+
+    @staticmethod
+    def score_counter(user_key):
+        return 'user-score:{}'.format(user_key.id())
+
+    @classmethod
+    def load_totals(cls, users):
+        """Reads the lifetime totals of several users in one batch."""
+        names = []
+        for user in users:
+            names.append(cls.games_counter(user.key))
+            names.append(cls.score_counter(user.key))
+        totals = counters.get_counts(names)
+        for user in users:
+            user._counter_totals = (totals[cls.games_counter(user.key)],
+                                    totals[cls.score_counter(user.key)])
+
+    @classmethod
+    @ndb.tasklet
+    def add_credit_async(cls, user_key, points, games=0):
+        """Adds points (which may be negative) and completed games to a
+        player's lifetime totals and ranking in the current cross-group
+        transaction, without reading or writing the User. Returns a Future
+        for the player's ranking, or for None if it wasn't updated, to pass
+        to finish_credit_async() once the transaction commits.
+        """
+        futures = []
+        if games:
+            futures.append(counters.add_to_shard_async(
+                cls.games_counter(user_key), games))
+        if points:
+            futures.append(counters.add_to_shard_async(
+                cls.score_counter(user_key), points))
+            futures.append(counters.add_to_shard_async(
+                TOTAL_SCORE_COUNTER, points))
+            futures.append(leaderboard.add_points_async(user_key, points))
+        results = yield futures
+        raise ndb.Return(results[-1] if points else None)
+
+    @classmethod
+    @ndb.tasklet
+    def finish_credit_async(cls, user_key, points, games=0, ranking=None,
+                            recount=False):
+        """Updates the cached totals and seeds the ranking of a credit
+        committed with add_credit_async(), returning a Future. If recount is
+        set, because an earlier attempt may have updated them already, the
+        cached totals are dropped to be recomputed from the counters instead.
+        """
+        deltas = {}
+        if games:
+            deltas[cls.games_counter(user_key)] = games
+        if points:
+            deltas[cls.score_counter(user_key)] = points
+            deltas[TOTAL_SCORE_COUNTER] = points
+        if recount:
+            yield counters.drop_cached_totals_async(deltas.keys())
+        else:
+            yield [counters.update_cached_total_async(name, delta)
+                   for name, delta in deltas.iteritems()]
+        # The ranking is seeded from the player's updated score
+        if points:
+            if ranking is None:
+                ranking = yield leaderboard.seed_async(user_key)
+            yield leaderboard.uncache_top_async(ranking)
+
+    @staticmethod
+    def average_score():
+        """Returns the average lifetime score across all players."""
+        totals = counters.get_counts([TOTAL_SCORE_COUNTER, USER_COUNT_COUNTER])
+        if not totals[USER_COUNT_COUNTER]:
+            return 0.0
+        return float(totals[TOTAL_SCORE_COUNTER]) / totals[USER_COUNT_COUNTER]
+
+    @classmethod
+    def rebuild_score_aggregates(cls):
+        """Recomputes the global total score and player count aggregates and
+        the player rankings from every player's lifetime score. Only needed
+        once to seed them for players created before they were maintained.
+        """
+        count = total_score = 0
+        cursor, more = None, True
+        while more:
+            users, cursor, more = cls.query().fetch_page(
+                500, start_cursor=cursor)
+            cls.load_totals(users)
+            count += len(users)
+            total_score += sum(user.score for user in users)
+            leaderboard.set_scores(dict((user.name, user.score)
+                                        for user in users))
+        counters.reset(TOTAL_SCORE_COUNTER, total_score)
+        counters.reset(USER_COUNT_COUNTER, count)
 
     def to_form(self):
         return UserForm(name=self.name,
@@ -19,76 +178,151 @@ class User(ndb.Model):
                         games=self.games,
                         score=self.score)
 
-    def add_match(self, game_size):
-        """Adds the points for the match to the lifetime total"""
-        points = int(math.pow(game_size, 2))
-        self.score += points
-        self.put()
-        return points
-
-    def add_game(self):
-        """Adds a completed game to the lifetime total"""
-        self.games += 1
-        self.put()
-
-    def remove_points(self, points):
-        """Removes points previously scored during a now cancelled game."""
-        self.score - points
-        self.put()
-
 
 class GameState:
     """Enumeration for the status of a game."""
     Active, Completed, Cancelled = range(3)
+    Names = ["active", "completed", "cancelled"]
 
 
-class Game(ndb.Model):
+class Game(cache.CachedModel):
     """Game object"""
-    board = ndb.PickleProperty(required=True)
+    board = BoardProperty(required=True)
     status = ndb.IntegerProperty(default=GameState.Active)
     user = ndb.KeyProperty(kind='User')
     score = ndb.IntegerProperty(default=0)
-    history = ndb.PickleProperty(required=True)
+    # Points of this game already added to the player's lifetime total.
+    # Games saved before scores were credited per game have None: their
+    # points were credited as each match was made.
+    credited = ndb.IntegerProperty()
     size = ndb.IntegerProperty(required=True)
+    # The move history is an append-only log: full segments of moves are
+    # stored as child HistorySegments, the newest moves in history_tail
+    moves = ndb.IntegerProperty(default=0)
+    history_tail = ndb.BlobProperty(default='')
+    # Games saved before history segments kept all moves in a pickled list
+    history = ndb.PickleProperty()
+    # Time of the last put, which the reaper uses to find idle games
+    updated = ndb.DateTimeProperty()
+    # Archived (finished) games hold their whole history in history_archive
+    archived = ndb.BooleanProperty(default=False)
+    history_archive = ndb.BlobProperty(compressed=True)
+    # Results of the latest moves made with a client's move token, as
+    # [token, encoded MoveResultForm] pairs, so that retries aren't reapplied
+    move_tokens = ndb.JsonProperty()
+
+    def _pre_put_hook(self):
+        super(Game, self)._pre_put_hook()
+        # A game being moved keeps the time it was last played
+        if not getattr(self, '_keep_updated', False):
+            self.updated = datetime.utcnow()
 
     @classmethod
     def new_game(cls, size, user):
         """Creates and returns a new game"""
-        game = Game(status=GameState.Active,
-                    user=user,
-                    score=0,
-                    size=size)
-
-        # Structure the Game as a child of its User creator
-        game_id = Game.allocate_ids(size=1, parent=user)[0]
-        game.key = ndb.Key(Game, game_id, parent=user)
-
-        # Setup the board
-        board = []
-        values = [i for i in range(size)]
-
-        # Copy and append the list to itself: each card value gets a match
-        values.extend(values)
-
-        # Shuffle the card order
-        random.shuffle(values)
-
-        # Create the card objects and add to the board
-        for value in values:
-            # Card: Each card (named by int) has a match in the deck
-            # Cleared: indicates if the card's still on the board (unmatched)
-            card = {}
-            card["value"] = value
-            card["cleared"] = False
-            board.append(card)
-        game.board = board
-        game.history = []
-        game.put()
-        return game
-
-    def make_move(self, card1, card2):
+        return cls.new_games(size, user, 1)[0]
+
+    @classmethod
+    def new_games(cls, size, user, count):
+        """Creates and returns count new games of the same size, allocating
+        their ids in one call and putting them in one batch.
+        """
+        # Games are root entities, linked to their User by the user property,
+        # so a player's concurrent games don't share an entity group
+        first, last = cls.allocate_ids(size=count)
+        games = []
+        for game_id in range(first, last + 1):
+            # Setup the board: each card (named by int) has a match in the
+            # deck
+            games.append(cls(key=ndb.Key(cls, game_id),
+                             status=GameState.Active,
+                             user=user,
+                             score=0,
+                             credited=0,
+                             size=size,
+                             board=Board.deal(size)))
+        with cache.batched_updates():
+            ndb.put_multi(games)
+        return games
+
+    @classmethod
+    def move_to_root(cls, key, game_id):
+        """Moves a game stored as a child of its User, along with its history
+        segments and Score, to a root Game with the given id. Returns the new
+        key, or None if the game no longer exists.
+
+        The game keeps its update time. Games saved before update times were
+        kept are given the date of their Score if they were completed, and
+        the current time otherwise, which starts their idle time for the
+        reaper. Their archived flag is stored, so the archiver finds them.
+        """
+        root_key = ndb.Key(cls, game_id)
+
+        @ndb.transactional(xg=True)
+        def txn():
+            game = key.get()
+            if game is None:
+                return None
+            children = [entity for entity in ndb.Query(ancestor=key)
+                        if entity.key != key]
+            copy = cls(key=root_key, **game.to_dict())
+            if copy.updated is None:
+                scores = [child for child in children
+                          if isinstance(child, Score)]
+                copy.updated = datetime.combine(scores[0].date,
+                                                datetime.min.time()) \
+                    if scores else datetime.utcnow()
+            copy._keep_updated = True
+            copies = [copy]
+            for child in children:
+                # Re-root the child's key path under the new game key
+                pairs = root_key.pairs() + child.key.pairs()[len(key.pairs()):]
+                copy = child.__class__(key=ndb.Key(pairs=pairs),
+                                       **child.to_dict())
+                if isinstance(copy, Score):
+                    copy.game = root_key
+                copies.append(copy)
+            ndb.put_multi(copies)
+            ndb.delete_multi([key] + [child.key for child in children])
+            return root_key
+        return txn()
+
+    def make_move(self, card1, card2, move_token=None):
+        """Makes a move and saves the game. Returns True if the cards match.
+        The result of a move made with a move_token is saved with the game,
+        for move_result_for_token().
+        """
+        matched = self.apply_move(card1, card2)
+        if move_token:
+            self._unsaved_token_move = (move_token, card1, card2, matched)
+        self.commit_moves()
+        return matched
+
+    def move_result_for_token(self, move_token):
+        """Returns the MoveResultForm of the move made with the token, or
+        None if it isn't one of the game's latest token moves.
+        """
+        for token, result in self.move_tokens or []:
+            if token == move_token:
+                return protojson.decode_message(MoveResultForm, result)
+        return None
+
+    def _remember_move(self, move_token, card1, card2, matched):
+        result = self.move_result(card1, card2, matched)
+        # The version the game is about to be saved with
+        result.version = self.version + 1
+        tokens = (self.move_tokens or []) + \
+            [[move_token, protojson.encode_message(result)]]
+        self.move_tokens = tokens[-MOVE_TOKENS_KEPT:]
+
+    def apply_move(self, card1, card2):
+        """Checks and applies a move to the game without saving it, so that
+        several moves can be saved together by commit_moves(). Returns True if
+        the cards match.
+        """
         # Verify selected card exists
-        card_count = len(self.board)
+        board = self.board
+        card_count = len(board)
         if card1 < 0 or \
            card1 >= card_count or \
            card2 < 0 or \
@@ -96,83 +330,420 @@ class Game(ndb.Model):
             raise ValueError('Invalid move! Selected cards must be 0 or greater'
                              ' and less than {}'.format(card_count))
 
+        if card1 == card2:
+            raise ValueError('Invalid move! Selected cards must be different.')
+
         # Verify selected cards are still available
-        if self.board[card1]["cleared"] or \
-           self.board[card2]["cleared"]:
+        if board.is_cleared(card1) or board.is_cleared(card2):
             raise ValueError('Invalid move! One or both cards are not available.')
 
+        # Games saved before points were credited per game had each match
+        # credited as it was made: the points so far are the baseline, and
+        # later matches are credited when the game ends
+        if self.credited is None:
+            self.credited = self.score
+
         # Check if there is a match
-        if self.board[card1]["value"] == self.board[card2]["value"]:
-            self.board[card1]["cleared"] = self.board[card2]["cleared"] = True
+        matched = board.value(card1) == board.value(card2)
+        if matched:
+            board.clear_pair(card1, card2)
             self.tally_match()
 
         # Append a move to the history
-        move = (card1, card2)
-        self.history.append(move)
-
+        self.record_move(card1, card2)
+        return matched
+
+    def commit_moves(self):
+        """Saves the moves applied since the last commit, ending the game if
+        it is won. Raises ConcurrentMoveError, saving nothing, if another
+        request saved the game since it was read.
+        """
         # Check if the game is won
         complete = check_complete(self.board)
         if complete:
             self.end_game()
 
-            # Send congratulations mail with total score
-            taskqueue.add(url='/tasks/send_congrats_email',
-                          params={'user_key': self.user.urlsafe(),
-                                  'game_key': self.key.urlsafe()})
-
         # Report the card values and current board state
         else:
+            self.save()
+
+    def save(self):
+        """Puts the game along with any history segments it has filled, if
+        the stored game still has the version this one was read at. Raises
+        ConcurrentMoveError otherwise.
+        """
+        self.save_async().get_result()
+
+    @ndb.tasklet
+    def save_async(self, entities=(), tasks=()):
+        """Asynchronous save(), returning a Future. The other entities, which
+        must belong to the game's entity group, are put and the tasks
+        enqueued in the same transaction, so they only happen if the game is
+        saved.
+        """
+        token_move = getattr(self, '_unsaved_token_move', None)
+        if token_move:
+            self._remember_move(*token_move)
+        expected_version = self.version
+        segments = getattr(self, '_unsaved_segments', [])
+
+        @ndb.tasklet
+        def txn():
+            # Compare-and-set on the version. This object may be the one in
+            # the in-context cache, so the stored game is read past it.
+            stored = yield self.key.get_async(use_cache=False)
+            if stored is None or stored.version != expected_version:
+                raise ConcurrentMoveError(
+                    'The game was changed by another request.')
+            yield ([ndb.put_multi_async([self] + segments + list(entities))] +
+                   [_add_task_async(task, transactional=True)
+                    for task in tasks])
+
+        # The game's entities share an entity group, so this is a single
+        # group transaction. It isn't retried: moves that lose a race must
+        # be checked again against the game the other request saved.
+        try:
+            yield ndb.transaction_async(txn, retries=0)
+        except datastore_errors.TransactionFailedError:
+            raise ConcurrentMoveError(
+                'The game was changed by another request.')
+        self._unsaved_segments = []
+        self._unsaved_token_move = None
+
+    def record_move(self, card1, card2):
+        """Appends a move to the history. Once the history tail holds a full
+        segment of moves it is sealed into a HistorySegment, which is written
+        on the next save() and never rewritten.
+        """
+        if self.history is not None:
+            self._migrate_history()
+        self.history_tail = append_move(self.history_tail, card1, card2)
+        self.moves += 1
+        if self.moves % MOVES_PER_SEGMENT == 0:
+            index = self.moves // MOVES_PER_SEGMENT - 1
+            segment = HistorySegment(
+                key=HistorySegment.key_for(self.key, index),
+                moves=self.history_tail)
+            if not hasattr(self, '_unsaved_segments'):
+                self._unsaved_segments = []
+            self._unsaved_segments.append(segment)
+            self.history_tail = ''
+
+    def _migrate_history(self):
+        """Moves a legacy pickled history list into history segments."""
+        legacy, self.history = self.history, None
+        self.moves = 0
+        self.history_tail = ''
+        for card1, card2 in legacy:
+            self.record_move(card1, card2)
+
+    def get_history(self, start=0, end=None):
+        """Returns the moves from index start up to (not including) end.
+        Only the history segments covering that range are read.
+        """
+        if self.history is not None:
+            return self.history[start:end]
+        if self.archived:
+            return unpack_moves(self.history_archive)[start:end]
+        if end is None or end > self.moves:
+            end = self.moves
+        if start >= end:
+            return []
+
+        sealed = self.moves // MOVES_PER_SEGMENT
+        first = start // MOVES_PER_SEGMENT
+        last = min(sealed, (end - 1) // MOVES_PER_SEGMENT + 1)
+        keys = [HistorySegment.key_for(self.key, index)
+                for index in range(first, last)]
+        moves = []
+        for segment in ndb.get_multi(keys):
+            moves.extend(unpack_moves(segment.moves))
+        if end > sealed * MOVES_PER_SEGMENT:
+            moves.extend(unpack_moves(self.history_tail))
+
+        offset = first * MOVES_PER_SEGMENT
+        return moves[start - offset:end - offset]
+
+    def archive(self):
+        """Packs the whole history of a finished game into one compressed
+        blob on the game and deletes its history segments. The summary
+        properties are unchanged, so the game can still be queried.
+        """
+        segment_keys = [HistorySegment.key_for(self.key, index)
+                        for index in range(self.moves // MOVES_PER_SEGMENT)]
+        if self.history is not None:
+            segment_keys = []
+
+        @ndb.transactional
+        def txn():
+            self.history_archive = pack_moves(self.get_history())
+            self.history = None
+            self.history_tail = ''
+            self.archived = True
             self.put()
-
-    def to_form(self, hide_solution=True, card1=None, card2=None):
-        """Returns a GameForm representation of the Game."""
-        board = self.board
-        # Don't expose the card values if this is an active game
-        if hide_solution:
-            board = list(self.board)
-            index = 0
-            for card in board:
-                # Only show the values of the chosen cards if a move is made
-                if card1 != index and card2 != index:
-                    card.pop("value")
-                index += 1
-
+            ndb.delete_multi(segment_keys)
+        txn()
+
+    def to_form(self, hide_solution=True, card1=None, card2=None,
+                summary=False):
+        """Returns a GameForm representation of the Game. A summary form
+        leaves out the board.
+        """
         # Report the status as a string
-        strings = ["active", "completed", "cancelled"]
-        status = strings[self.status]
+        status = GameState.Names[self.status]
 
         form = GameForm(urlsafe_key=self.key.urlsafe(),
-                        board=str(board),
                         status=status,
-                        score=self.score)
+                        score=self.score,
+                        size=self.size,
+                        moves=self.moves,
+                        version=self.version)
+        if not summary:
+            # Don't expose the card values if this is an active game. Only
+            # show the values of the chosen cards if a move is made.
+            board = self.board.to_list(hide_solution, reveal=(card1, card2))
+            form.board = str(board)
         return form
 
+    def move_result(self, card1, card2, matched):
+        """Returns a MoveResultForm for a move just made: the two revealed
+        cards and the game's counters, without the rest of the board.
+        """
+        return MoveResultForm(card1=card1,
+                              card2=card2,
+                              value1=self.board.value(card1),
+                              value2=self.board.value(card2),
+                              matched=matched,
+                              remaining=self.board.remaining,
+                              score=self.score,
+                              status=GameState.Names[self.status],
+                              version=self.version)
+
+    @instrumented('Game.tally_match')
     def tally_match(self):
-        """Adds the points for the new match to the player's lifetime total."""
-        points = self.user.get().add_match(self.size)
-        self.score += points
-
+        """Adds the points for the new match to the game score. They are
+        added to the player's lifetime total when the game ends.
+        """
+        self.score += int(math.pow(self.size, 2))
+
+    def uncredited_points(self):
+        """Returns the points not yet added to the player's lifetime total."""
+        if self.credited is None:
+            return 0
+        return self.score - self.credited
+
+    @instrumented('Game.end_game')
     def end_game(self):
-        """Ends the game."""
+        """Ends the game, credits the player with its points and sends them
+        a congratulations email.
+        """
+        self.end_game_async().get_result()
+
+    @ndb.tasklet
+    def end_game_async(self):
+        """Asynchronous end_game(), returning a Future. The game, its Score
+        and the task crediting the player are committed together, so a
+        request that loses a race to end the game has no effect.
+        """
+        points = self.uncredited_points()
         self.status = GameState.Completed
-        self.put()
-        score = Score(date=date.today(), size=self.size, user=self.user, game=self.key)
-
-        # Structure the Score as a child the Game to which it represents
-        score_id = Score.allocate_ids(size=1, parent=self.key)[0]
-        score.key = ndb.Key(Score, score_id, parent=self.key)
+        self.credited = self.score
 
-        score.put()
+        # Structure the Score as a child the Game to which it represents.
+        # Its id is allocated by the put.
+        score = Score(parent=self.key, date=date.today(), size=self.size,
+                      user=self.user, game=self.key, user_name=self.user.id())
 
-        # Update the user models
-        self.user.get().add_game()
+        yield self.save_async(entities=[score],
+                              tasks=[self._credit_task(points, games=1)])
 
+    @instrumented('Game.cancel_game')
     def cancel_game(self):
-        """Cancels the game."""
+        """Cancels the game. Raises ConcurrentMoveError if another request
+        saved the game since it was read.
+        """
+        credited = self.score - self.uncredited_points()
         self.status = GameState.Cancelled
-        self.put()
+        self.credited = 0
         # Previous points for this game are recalled
-        self.user.get().remove_points(self.score)
+        self.save_async(tasks=[self._credit_task(-credited)]).get_result()
+
+    def _credit_task(self, points, games=0):
+        """Returns the task that credits the player with the points (which
+        may be negative) and completed games of the game being finished, and
+        adds the game to their statistics. It is enqueued in the transaction
+        that saves the game, so the player can't miss the credit of a game
+        whose end was saved.
+        """
+        return taskqueue.Task(url='/tasks/credit_game',
+                              params={'user_key': self.user.urlsafe(),
+                                      'game_key': self.key.urlsafe(),
+                                      'points': points,
+                                      'games': games,
+                                      'status': self.status,
+                                      'moves': self.moves,
+                                      'score': self.score,
+                                      'size': self.size})
+
+
+@ndb.tasklet
+def _add_task_async(task, transactional=False):
+    """Enqueues the task on the default queue, returning a Future."""
+    rpc = taskqueue.Queue().add_async(task, transactional=transactional)
+    yield rpc
+    raise ndb.Return(rpc.get_result())
+
+
+class HistorySegment(ndb.Model):
+    """A full, fixed-size segment of a Game's move history"""
+    moves = ndb.BlobProperty(required=True)
+
+    @staticmethod
+    def key_for(game_key, index):
+        """Returns the key of the game's index'th (zero based) segment."""
+        # Structure the segment as a child of the Game it records
+        return ndb.Key(HistorySegment, index + 1, parent=game_key)
+
+
+class UserStats(cache.CachedModel):
+    """A player's statistics over their finished games, updated as each
+    game ends. Keyed by player name."""
+    completed = ndb.IntegerProperty(default=0, indexed=False)
+    cancelled = ndb.IntegerProperty(default=0, indexed=False)
+    # Moves made in completed games
+    total_moves = ndb.IntegerProperty(default=0, indexed=False)
+    best_score = ndb.IntegerProperty(default=0, indexed=False)
+    # Board size -> [completed games, fewest moves to complete one]
+    sizes = ndb.JsonProperty()
+
+    @classmethod
+    def record_game(cls, record, points, games=0, tasks=()):
+        """Adds a finished game, given as its GameRecord, to the player's
+        statistics and credits the player with the game's points (which may
+        be negative) and completed games, unless that was done already. The
+        record, the statistics and the player's counters and ranking are
+        written in one cross-group transaction, and the tasks enqueued in it,
+        so a retried credit task has no effect.
+        """
+        user_key = ndb.Key(User, record.key.parent().id())
+
+        @ndb.tasklet
+        def txn():
+            stored, stats = yield (record.key.get_async(),
+                                   record.key.parent().get_async())
+            if stored is not None and stored.credited:
+                raise ndb.Return(False, None)
+            entities = []
+            if stored is None:
+                stats = stats or cls(key=record.key.parent())
+                stats.add(record)
+                entities.append(stats)
+                stored = record
+            stored.credited = True
+            entities.append(stored)
+            ranking, _, _ = yield (
+                User.add_credit_async(user_key, points, games),
+                ndb.put_multi_async(entities),
+                [_add_task_async(task, transactional=True) for task in tasks])
+            raise ndb.Return(True, ranking)
+        credited, ranking = ndb.transaction(txn, xg=True)
+        # Finish the credit even if an earlier attempt committed it, as that
+        # attempt may have failed before finishing it
+        User.finish_credit_async(user_key, points, games, ranking,
+                                 recount=not credited).get_result()
+
+    @classmethod
+    def rebuild(cls, user_key):
+        """Recomputes the player's statistics from their finished games.
+        Games without a GameRecord, such as those finished before statistics
+        were kept, are recorded first, in batches. The statistics are then
+        summed from all the records in one transaction, so games recorded by
+        credit tasks meanwhile are neither lost nor counted twice.
+        """
+        key = ndb.Key(cls, user_key.id())
+        for status in (GameState.Completed, GameState.Cancelled):
+            query = Game.query(Game.user == user_key, Game.status == status)
+            cursor, more = None, True
+            while more:
+                games, cursor, more = query.fetch_page(
+                    RECORD_BATCH_SIZE, start_cursor=cursor)
+                if games:
+                    cls._add_records([GameRecord.for_game(game)
+                                      for game in games])
+
+        @ndb.transactional
+        def txn():
+            # The statistics are summed afresh, keeping their version
+            stored = key.get()
+            stats = cls(key=key, version=stored.version if stored else 0)
+            for record in GameRecord.query(ancestor=key):
+                stats.add(record)
+            stats.put()
+        txn()
+
+    @staticmethod
+    @ndb.transactional
+    def _add_records(records):
+        """Stores the records of a player's games that have none yet."""
+        stored = ndb.get_multi([record.key for record in records])
+        ndb.put_multi([record for record, existing in zip(records, stored)
+                       if existing is None])
+
+    def add(self, record):
+        """Adds a finished game's GameRecord to the statistics."""
+        if record.status == GameState.Completed:
+            self.completed += 1
+            self.total_moves += record.moves
+            self.best_score = max(self.best_score, record.score)
+            sizes = dict(self.sizes or {})
+            games, fewest = sizes.get(str(record.size), (0, record.moves))
+            sizes[str(record.size)] = [games + 1, min(fewest, record.moves)]
+            self.sizes = sizes
+        else:
+            self.cancelled += 1
+
+    def to_form(self):
+        finished = self.completed + self.cancelled
+        sizes = sorted((int(size), games, fewest) for size, (games, fewest)
+                       in (self.sizes or {}).iteritems())
+        return UserStatsForm(
+            name=self.key.id(),
+            completed=self.completed,
+            cancelled=self.cancelled,
+            completion_rate=float(self.completed) / finished
+            if finished else None,
+            total_moves=self.total_moves,
+            average_moves=float(self.total_moves) / self.completed
+            if self.completed else None,
+            best_score=self.best_score,
+            sizes=[SizeStatsForm(size=size, games=games, fewest_moves=fewest)
+                   for size, games, fewest in sizes])
+
+
+class GameRecord(ndb.Model):
+    """The summary of a finished game, stored as a child of its player's
+    UserStats when the game is added to the statistics. Keyed by the id of
+    the (root) game, so each game is only added and credited once.
+    """
+    status = ndb.IntegerProperty(required=True, indexed=False)
+    moves = ndb.IntegerProperty(default=0, indexed=False)
+    score = ndb.IntegerProperty(default=0, indexed=False)
+    size = ndb.IntegerProperty(indexed=False)
+    # Whether the player was credited with the game by its credit task
+    credited = ndb.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    def key_for(user_key, game_key):
+        return ndb.Key(GameRecord, game_key.id(),
+                       parent=ndb.Key(UserStats, user_key.id()))
+
+    @classmethod
+    def for_game(cls, game):
+        """Returns a new record of the finished game."""
+        # Games finished before history segments still hold a pickled list
+        moves = len(game.history) if game.history is not None else game.moves
+        return cls(key=cls.key_for(game.user, game.key), status=game.status,
+                   moves=moves, score=game.score, size=game.size)
 
 
 class Score(ndb.Model):
@@ -181,25 +752,49 @@ class Score(ndb.Model):
     size = ndb.IntegerProperty(required=True)
     user = ndb.KeyProperty(kind='User')
     game = ndb.KeyProperty(kind='Game')
+    # The player's name, copied from the User when the Score is recorded
+    user_name = ndb.StringProperty(indexed=False)
 
-    def to_form(self):
+    def to_form(self, user_name=None):
         return ScoreForm(date=str(self.date),
                          size=int(math.pow(self.size, 2)),
-                         user=self.user.get().name,
+                         user=user_name or self.user_name or
+                         self.user.get().name,
                          game=self.game.urlsafe())
 
+    @staticmethod
+    def to_forms(scores, next_cursor=None):
+        """Returns a ScoreForms of the scores. The names of players missing
+        from older Scores are looked up together in a single batch get.
+        """
+        scores = list(scores)
+        missing = list(set(score.user for score in scores
+                           if not score.user_name))
+        names = {}
+        if missing:
+            for key, user in zip(missing, ndb.get_multi(missing)):
+                names[key] = user.name
+        return ScoreForms(items=[score.to_form(names.get(score.user))
+                                 for score in scores],
+                          next_cursor=next_cursor)
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
     status = messages.StringField(2, required=True)
     score = messages.IntegerField(3, required=True)
-    board = messages.StringField(4, required=True)
+    board = messages.StringField(4)
+    size = messages.IntegerField(5)
+    moves = messages.IntegerField(6)
+    version = messages.IntegerField(7)
+    not_modified = messages.BooleanField(8)
 
 
 class GameForms(messages.Message):
     """Container for multiple GameForm"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
@@ -208,10 +803,50 @@ class NewGameForm(messages.Message):
     user = messages.StringField(2, required=True)
 
 
+class NewGamesForm(messages.Message):
+    """Used to create a batch of new games"""
+    size = messages.IntegerField(1, default=4)
+    user = messages.StringField(2, required=True)
+    count = messages.IntegerField(3, required=True)
+
+
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     card1 = messages.IntegerField(1, required=True)
     card2 = messages.IntegerField(2, required=True)
+    move_token = messages.StringField(3)
+    version = messages.IntegerField(4)
+
+
+class MoveForm(messages.Message):
+    """One move of a series"""
+    card1 = messages.IntegerField(1, required=True)
+    card2 = messages.IntegerField(2, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make a series of moves in an existing game"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm for the outcome of a single move"""
+    card1 = messages.IntegerField(1, required=True)
+    card2 = messages.IntegerField(2, required=True)
+    value1 = messages.IntegerField(3)
+    value2 = messages.IntegerField(4)
+    matched = messages.BooleanField(5)
+    error = messages.StringField(6)
+    remaining = messages.IntegerField(7)
+    score = messages.IntegerField(8)
+    status = messages.StringField(9)
+    version = messages.IntegerField(10)
+
+
+class MoveResultForms(messages.Message):
+    """Outcome of each move of a series, and the resulting game state"""
+    items = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
 
 
 class ScoreForm(messages.Message):
@@ -225,6 +860,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -243,3 +879,38 @@ class UserForm(messages.Message):
 class UserForms(messages.Message):
     """Container for multiple User Forms"""
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class SizeStatsForm(messages.Message):
+    """A player's completed games of one board size"""
+    size = messages.IntegerField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+    fewest_moves = messages.IntegerField(3, required=True)
+
+
+class UserStatsForm(messages.Message):
+    """A player's statistics over their finished games"""
+    name = messages.StringField(1, required=True)
+    completed = messages.IntegerField(2, required=True)
+    cancelled = messages.IntegerField(3, required=True)
+    completion_rate = messages.FloatField(4)
+    total_moves = messages.IntegerField(5, required=True)
+    average_moves = messages.FloatField(6)
+    best_score = messages.IntegerField(7, required=True)
+    sizes = messages.MessageField(SizeStatsForm, 8, repeated=True)
+
+
+class RankForm(messages.Message):
+    """RankForm for a player's position in the rankings"""
+    name = messages.StringField(1, required=True)
+    score = messages.IntegerField(2, required=True)
+    rank = messages.IntegerField(3, required=True)
+    # Set if more players are ranked ahead than were counted, so the player
+    # is ranked lower than 'rank'
+    approximate = messages.BooleanField(4, default=False)
+
+
+class RankForms(messages.Message):
+    """Container for multiple RankForms"""
+    items = messages.MessageField(RankForm, 1, repeated=True)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Benchmarks the API and model layer locally against the testbed stubs.
+
+Reports latency percentiles, datastore and memcache RPCs and serialized
+entity bytes per operation as JSON, so that runs from different commits can
+be compared:
+
+    python tools/benchmark.py --output bench.json
+    python tools/benchmark.py --sizes 1,100,500 --users 100 --repeat 50
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import stubs
+
+
+def _csv_ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+class Benchmark(object):
+    """Runs operations and collects their measurements."""
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+        self.counter = stubs.RpcCounter()
+
+    def measure(self, operation, params, run, setup=None, entity_bytes=None):
+        """Times repeat calls of run(i), each after an untimed setup(i), and
+        records the latency percentiles and mean RPC counts.
+        """
+        from google.appengine.ext import ndb
+        latencies = []
+        rpcs = {}
+        for i in range(self.repeat):
+            if setup:
+                setup(i)
+            # Measure each call from a cold in-context cache
+            ndb.get_context().clear_cache()
+            self.counter.start()
+            started = time.time()
+            run(i)
+            latencies.append((time.time() - started) * 1000)
+            for call, count in self.counter.stop().items():
+                rpcs[call] = rpcs.get(call, 0) + count
+        result = {'operation': operation,
+                  'params': params,
+                  'samples': len(latencies),
+                  'mean_ms': round(sum(latencies) / len(latencies), 3),
+                  'p50_ms': round(stubs.percentile(latencies, 0.5), 3),
+                  'p90_ms': round(stubs.percentile(latencies, 0.9), 3),
+                  'p99_ms': round(stubs.percentile(latencies, 0.99), 3),
+                  'rpcs': dict((call, round(float(count) / len(latencies), 2))
+                               for call, count in sorted(rpcs.items()))}
+        if entity_bytes is not None:
+            result['entity_bytes'] = entity_bytes
+        self.results.append(result)
+        sys.stderr.write('{operation} {params}: p50 {p50_ms}ms p99 {p99_ms}ms '
+                         '{rpcs}\n'.format(**result))
+
+
+def _entity_bytes(entity):
+    from google.appengine.ext import ndb
+    return len(ndb.ModelAdapter().entity_to_pb(entity).Encode())
+
+
+def _create_user(name):
+    import api
+    request = api.NEW_USER_REQUEST.combined_message_class(
+        user_name=name, email='{}@example.com'.format(name))
+    api.MemoryGameAPI().create_user(request)
+    from google.appengine.ext import ndb
+    from models import User
+    return ndb.Key(User, name)
+
+
+def _next_move(game, rng):
+    """Returns a random pair of different uncleared cards of the game."""
+    board = game.board
+    cards = [card for card in range(len(board)) if not board.is_cleared(card)]
+    return rng.sample(cards, 2)
+
+
+def bench_games(bench, sizes):
+    import api
+    from models import Game
+    from utils import check_complete
+    service = api.MemoryGameAPI()
+    user = _create_user('bench-games')
+    rng = random.Random(0)
+
+    for size in sizes:
+        games = []
+        bench.measure('new_game', {'size': size},
+                      lambda i: games.append(Game.new_game(size, user)))
+        bench.measure('new_games', {'size': size, 'count': 100},
+                      lambda i: Game.new_games(size, user, 100))
+        game = games[-1]
+        game_bytes = _entity_bytes(game)
+
+        bench.measure('to_form', {'size': size},
+                      lambda i: game.to_form(hide_solution=True),
+                      entity_bytes=game_bytes)
+        bench.measure('check_complete', {'size': size},
+                      lambda i: check_complete(game.board))
+
+        # Play the move endpoint, starting a new game whenever one is won
+        state = {'game': Game.new_game(size, user)}
+
+        def setup(i):
+            current = state['game'].key.get()
+            if current.board.remaining == 0:
+                current = Game.new_game(size, user)
+            state['game'] = current
+            card1, card2 = _next_move(current, rng)
+            state['request'] = api.MAKE_MOVE_REQUEST.combined_message_class(
+                urlsafe_game_key=current.key.urlsafe(),
+                card1=card1, card2=card2)
+
+        bench.measure('make_move', {'size': size},
+                      lambda i: service.make_move(state['request']),
+                      setup=setup, entity_bytes=game_bytes)
+        bench.measure('get_game', {'size': size},
+                      lambda i: service.get_game(
+                          api.GET_GAME_IF_REQUEST.combined_message_class(
+                              urlsafe_game_key=game.key.urlsafe())),
+                      entity_bytes=game_bytes)
+
+
+def _seed_users_and_scores(users, scores):
+    """Creates the users, each with a ranking, and the completed scores."""
+    from datetime import date
+    from google.appengine.ext import ndb
+    import leaderboard
+    from models import User, Game, Score
+    rng = random.Random(1)
+    keys = [ndb.Key(User, 'bench-{}'.format(i)) for i in range(users)]
+    ndb.put_multi([User(key=key, name=key.id(),
+                        email='{}@example.com'.format(key.id()))
+                   for key in keys])
+    leaderboard.set_scores(dict((key.id(), rng.randint(1, 100000))
+                                for key in keys))
+    entities = []
+    for i in range(scores):
+        user = keys[i % len(keys)]
+        game = ndb.Key(Game, i + 1)
+        entities.append(Score(parent=game, date=date.today(),
+                              size=rng.randint(1, 500), user=user,
+                              game=game, user_name=user.id()))
+    ndb.put_multi(entities)
+    return keys
+
+
+def bench_tables(bench, user_counts, score_counts):
+    import api
+    service = api.MemoryGameAPI()
+    for users in user_counts:
+        for scores in score_counts:
+            bed = stubs.activate()
+            bench.counter.install()
+            try:
+                keys = _seed_users_and_scores(users, scores)
+                params = {'users': users, 'scores': scores}
+                bench.measure('get_user_rankings', params,
+                              lambda i: service.get_user_rankings(
+                                  api.GET_RANKINGS_REQUEST.
+                                  combined_message_class(limit=10)))
+                bench.measure('get_scores', params,
+                              lambda i: service.get_scores(
+                                  api.GET_SCORES_REQUEST.
+                                  combined_message_class()))
+                bench.measure('get_high_scores', params,
+                              lambda i: service.get_high_scores(
+                                  api.GET_HIGH_SCORES_REQUEST.
+                                  combined_message_class(results=10)))
+                bench.measure('get_user_scores', params,
+                              lambda i: service.get_user_scores(
+                                  api.USER_REQUEST.combined_message_class(
+                                      user_name=keys[0].id())))
+            finally:
+                bed.deactivate()
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=stubs.REPO_ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=_csv_ints,
+                        default=[1, 10, 50, 100, 250, 500],
+                        help='board sizes (number of pairs)')
+    parser.add_argument('--users', type=_csv_ints, default=[10, 100, 1000],
+                        help='user table sizes')
+    parser.add_argument('--scores', type=_csv_ints, default=[10, 100, 1000],
+                        help='score table sizes')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='samples per operation')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    stubs.setup_path()
+    bench = Benchmark(args.repeat)
+    bed = stubs.activate()
+    bench.counter.install()
+    try:
+        bench_games(bench, args.sizes)
+    finally:
+        bed.deactivate()
+    bench_tables(bench, args.users, args.scores)
+
+    report = json.dumps({'revision': _git_revision(),
+                         'timestamp': time.time(),
+                         'repeat': args.repeat,
+                         'results': bench.results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""Plays simulated games concurrently against the API and the testbed stubs.
+
+Simulated players create games and play them to the end through the
+MemoryGameAPI methods, from a pool of threads, and the throughput, latency
+percentiles per endpoint and the rate of conflicting saves are reported as
+JSON. Three scenarios are played:
+
+    many-users    each of --players players plays --games games in turn
+    one-user      a single player plays --players * --games games at once
+    shared-games  --players clients move in each of --games games at once
+
+Sharing games makes moves race to save the same game, so the retries and
+conflicts of the version compare-and-set are measured. In every scenario,
+a --resend-fraction of the moves are sent a second time with the same move
+token, as by a client whose response was lost, and checked to get the first
+result back.
+
+    python tools/loadgen.py --scenario one-user --players 50 --threads 16
+    python tools/loadgen.py --sizes 4,16 --strategy memory --output load.json
+
+Players either pick random cards or remember every card they have seen and
+match pairs as soon as they know them. With --data, an export written by
+transfer.py is loaded first, so that games are played against a datastore of
+realistic size.
+"""
+import argparse
+import ast
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import stubs, transfer
+
+SCENARIOS = ['many-users', 'one-user', 'shared-games']
+STRATEGIES = ['random', 'memory']
+
+
+def _csv_ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+class Recorder(object):
+    """Times the endpoint calls of all the threads."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+
+    def call(self, endpoint, method, request):
+        """Calls the endpoint method as a request of its own, recording its
+        latency, or the type of the error it raised."""
+        from google.appengine.ext import ndb
+        ndb.get_context().clear_cache()
+        started = time.time()
+        try:
+            return method(request)
+        except Exception as error:
+            with self._lock:
+                self.errors[endpoint][type(error).__name__] += 1
+            raise
+        finally:
+            elapsed_ms = (time.time() - started) * 1000
+            with self._lock:
+                self.latencies[endpoint].append(elapsed_ms)
+
+    def report(self):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            endpoints[endpoint] = {
+                'calls': len(latencies),
+                'errors': dict(self.errors[endpoint]),
+                'mean_ms': round(sum(latencies) / len(latencies), 3),
+                'p50_ms': round(stubs.percentile(latencies, 0.5), 3),
+                'p90_ms': round(stubs.percentile(latencies, 0.9), 3),
+                'p99_ms': round(stubs.percentile(latencies, 0.99), 3),
+                'max_ms': round(max(latencies), 3)}
+        return endpoints
+
+
+class Player(object):
+    """Chooses the moves of one game, remembering the card values seen if
+    the strategy is 'memory'."""
+    def __init__(self, strategy, size, rng):
+        self.strategy = strategy
+        self.rng = rng
+        self.cards = 2 * size
+        self.cleared = set()
+        self.known = {}
+
+    def next_move(self):
+        cards = [card for card in range(self.cards)
+                 if card not in self.cleared]
+        if self.strategy == 'random':
+            return self.rng.sample(cards, 2)
+        # Match a known pair, or else turn over unseen cards
+        seen = {}
+        for card in cards:
+            value = self.known.get(card)
+            if value is None:
+                continue
+            if value in seen:
+                return seen[value], card
+            seen[value] = card
+        unknown = [card for card in cards if card not in self.known]
+        if len(unknown) >= 2:
+            return self.rng.sample(unknown, 2)
+        return unknown[0], self.rng.choice(seen.values())
+
+    def refresh(self, cards):
+        """Marks the cards another client cleared, from the game's board."""
+        for card, state in enumerate(cards):
+            if state['cleared']:
+                self.cleared.add(card)
+
+    def observe(self, result):
+        self.known[result.card1] = result.value1
+        self.known[result.card2] = result.value2
+        if result.matched:
+            self.cleared.update((result.card1, result.card2))
+
+
+def play_game(service, recorder, game_key, player, rng, resend_fraction):
+    """Plays moves in the game until it is over. Returns a Counter of the
+    moves made, refused with a conflict, or refused because another client
+    cleared a card first, and of the moves resent with their move token and
+    the resent moves whose result differed from the first.
+    """
+    import api
+    import endpoints
+    outcome = collections.Counter()
+    while True:
+        card1, card2 = player.next_move()
+        request = api.MAKE_MOVE_REQUEST.combined_message_class(
+            urlsafe_game_key=game_key, card1=card1, card2=card2,
+            move_token=uuid.uuid4().hex)
+        try:
+            result = recorder.call('make_move', service.make_move, request)
+        except endpoints.ConflictException:
+            outcome['conflicts'] += 1
+            continue
+        except endpoints.BadRequestException:
+            # Another client cleared one of the cards
+            outcome['stale_moves'] += 1
+            if not _refresh(service, recorder, game_key, player):
+                return outcome
+            continue
+        except Exception:
+            # Reported with the endpoint's errors; the game is abandoned
+            return outcome
+        outcome['moves'] += 1
+        player.observe(result)
+
+        # Resend the move as a client whose response was lost would
+        if rng.random() < resend_fraction:
+            outcome['resent'] += 1
+            try:
+                again = recorder.call('make_move (resent)', service.make_move,
+                                      request)
+            except Exception:
+                again = None
+            if again is None or (again.matched, again.version) != \
+                    (result.matched, result.version):
+                outcome['resent_mismatches'] += 1
+        if result.status != 'active':
+            return outcome
+
+
+def _refresh(service, recorder, game_key, player):
+    """Updates the player's cleared cards from the game. Returns whether the
+    game is still active."""
+    import api
+    game = recorder.call('get_game', service.get_game,
+                         api.GET_GAME_IF_REQUEST.combined_message_class(
+                             urlsafe_game_key=game_key))
+    player.refresh(ast.literal_eval(game.board))
+    return game.status == 'active'
+
+
+def _new_game(service, recorder, user_name, size):
+    """Creates a game, returning its urlsafe key, or None if it failed."""
+    import api
+    try:
+        return recorder.call('new_game', service.new_game,
+                             api.NEW_GAME_REQUEST.combined_message_class(
+                                 user=user_name, size=size)).urlsafe_key
+    except Exception:
+        # Reported with the endpoint's errors
+        return None
+
+
+def run(args, scenario, size):
+    """Plays one scenario with one board size and returns its results."""
+    import api
+    import instrumentation
+    service = api.MemoryGameAPI()
+    recorder = Recorder()
+    if scenario == 'many-users':
+        names = ['load-{}'.format(i) for i in range(args.players)]
+        owners = [name for _ in range(args.games) for name in names]
+    else:
+        names = ['load-0']
+        owners = names * (args.players * args.games)
+    for name in names:
+        recorder.call('create_user', service.create_user,
+                      api.NEW_USER_REQUEST.combined_message_class(
+                          user_name=name,
+                          email='{}@example.com'.format(name)))
+    if scenario == 'shared-games':
+        # Every player moves in each of the games at once
+        game_keys = [_new_game(service, recorder, names[0], size)
+                     for _ in range(args.games)]
+        tasks = [(key, None) for key in game_keys if key
+                 for _ in range(args.players)]
+    else:
+        tasks = [(None, owner) for owner in owners]
+
+    def play(index):
+        game_key, owner = tasks[index]
+        rng = random.Random(args.seed + index)
+        if owner:
+            game_key = _new_game(service, recorder, owner, size)
+            if not game_key:
+                return collections.Counter()
+        return play_game(service, recorder, game_key,
+                         Player(args.strategy, size, rng), rng,
+                         args.resend_fraction)
+
+    before = instrumentation.get_snapshot()['operations']
+    pool = ThreadPool(args.threads)
+    started = time.time()
+    try:
+        outcomes = pool.map(play, range(len(tasks)))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+    after = instrumentation.get_snapshot()['operations']
+
+    def conflicts_counted(operations):
+        stats = operations.get('api.make_move')
+        return stats['counters'].get('game_conflicts', 0) if stats else 0
+
+    total = sum(outcomes, collections.Counter())
+    moves = total['moves']
+    retried = conflicts_counted(after) - conflicts_counted(before)
+    attempts = moves + total['conflicts'] + total['stale_moves']
+    return {'scenario': scenario,
+            'params': {'players': len(names) if scenario != 'shared-games'
+                       else args.players,
+                       'games': args.games if scenario == 'shared-games'
+                       else len(tasks),
+                       'size': size, 'strategy': args.strategy,
+                       'threads': args.threads,
+                       'resend_fraction': args.resend_fraction},
+            'elapsed_s': round(elapsed, 3),
+            'moves': moves,
+            'moves_per_second': round(moves / elapsed, 2) if elapsed else None,
+            # Saves retried by the API after losing a race to save the game
+            # (the resent moves included), moves refused with a conflict
+            # after every retry lost, and moves refused because another
+            # client cleared a card first
+            'move_retries': retried,
+            'move_conflicts': total['conflicts'],
+            'stale_moves': total['stale_moves'],
+            'retry_rate': round(float(retried) / attempts, 4)
+            if attempts else None,
+            'conflict_rate': round(float(total['conflicts']) / attempts, 4)
+            if attempts else None,
+            # Moves resent with the same move token, and how many of those
+            # didn't get the original result back
+            'resent_moves': total['resent'],
+            'resent_mismatches': total['resent_mismatches'],
+            'endpoints': recorder.report()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='scenario to play (default: all)')
+    parser.add_argument('--players', type=int, default=20,
+                        help='number of simulated players')
+    parser.add_argument('--games', type=int, default=1,
+                        help='games per player')
+    parser.add_argument('--sizes', type=_csv_ints, default=[8],
+                        help='board sizes (number of pairs)')
+    parser.add_argument('--strategy', choices=STRATEGIES, default='memory',
+                        help='how players pick their cards')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='number of clients playing at once')
+    parser.add_argument('--resend-fraction', type=float, default=0.1,
+                        help='fraction of moves sent again with their token')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data', help='an export file (see transfer.py) to '
+                        'load before playing')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    stubs.setup_path()
+    results = []
+    for scenario in args.scenario or SCENARIOS:
+        for size in args.sizes:
+            bed = stubs.activate()
+            try:
+                if args.data:
+                    transfer.load_into_stubs(args.data, 500)
+                result = run(args, scenario, size)
+            finally:
+                bed.deactivate()
+            results.append(result)
+            sys.stderr.write(
+                '{scenario} {params}: {moves_per_second} moves/s, '
+                'retry rate {retry_rate}, conflict rate {conflict_rate}, '
+                '{resent_mismatches} of {resent_moves} resent moves '
+                'mismatched\n'.
+                format(**result))
+
+    report = json.dumps({'timestamp': time.time(), 'results': results},
+                        indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
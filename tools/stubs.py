@@ -0,0 +1,81 @@
+"""Helpers for running the app locally against the App Engine testbed stubs.
+
+The App Engine SDK is found through the APPENGINE_SDK environment variable,
+or the directory holding dev_appserver.py on the PATH.
+"""
+import collections
+import os
+import sys
+import threading
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_path():
+    """Puts the App Engine SDK, its bundled libraries and the app on
+    sys.path."""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if not sdk:
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            if os.path.exists(os.path.join(directory, 'dev_appserver.py')):
+                sdk = os.path.realpath(directory)
+                break
+    if not sdk:
+        sys.exit('Set APPENGINE_SDK to the App Engine Python SDK directory.')
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def activate():
+    """Activates and returns a testbed with the datastore, memcache, task
+    queue, mail and app identity stubs. The datastore is strongly
+    consistent, as is usual for local testing.
+    """
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=REPO_ROOT)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    ndb.get_context().clear_cache()
+    return bed
+
+
+class RpcCounter(object):
+    """Counts the API calls made by each thread between start() and
+    stop(), keyed by 'service.Call'."""
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'rpc_counter', self._hook)
+
+    def _hook(self, service, call, request, response):
+        counts = getattr(self._local, 'counts', None)
+        if counts is not None:
+            counts['{}.{}'.format(service, call)] += 1
+
+    def start(self):
+        self._local.counts = collections.Counter()
+
+    def stop(self):
+        counts, self._local.counts = self._local.counts, None
+        return counts
+
+
+def percentile(values, fraction):
+    """Returns the value at the given fraction (0 to 1) of the sorted
+    values."""
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
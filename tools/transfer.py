@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Exports the players, games and scores of a running app to a
+newline-delimited JSON file, or imports such a file into one.
+
+The app's /admin/export and /admin/import handlers are called a chunk at a
+time, and the progress is saved next to the file after each chunk, so an
+interrupted run continues where it stopped when run again with --resume:
+
+    python tools/transfer.py export https://APP.appspot.com data.ndjson \\
+        --cookie 'SACSID=...'
+    python tools/transfer.py import http://localhost:8080 data.ndjson \\
+        --cookie 'dev_appserver_login="test@example.com:True:1"' --resume
+
+The admin handlers require an administrator's login cookie. After an import,
+visit /admin/rebuild_score_aggregates to seed the counters and rankings.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib
+import urllib2
+
+# The exported kinds, in order, as listed in bulk.KINDS
+KINDS = ['User', 'UserStats', 'GameRecord', 'Game', 'HistorySegment',
+         'Score']
+
+
+def _request(url, cookie, data=None, content_type=None):
+    request = urllib2.Request(url, data)
+    if cookie:
+        request.add_header('Cookie', cookie)
+    if content_type:
+        request.add_header('Content-Type', content_type)
+    return urllib2.urlopen(request)
+
+
+def _progress_path(path):
+    return path + '.progress'
+
+
+def _load_progress(path, resume):
+    if resume and os.path.exists(_progress_path(path)):
+        with open(_progress_path(path)) as progress:
+            return json.load(progress)
+    return None
+
+
+def _save_progress(path, progress):
+    with open(_progress_path(path), 'w') as output:
+        json.dump(progress, output)
+
+
+def export(args):
+    """Exports each kind a chunk at a time, appending to the output file."""
+    progress = _load_progress(args.path, args.resume) or \
+        {'kind': KINDS[0], 'cursor': None, 'offset': 0}
+    with open(args.path, 'a' if args.resume else 'w') as output:
+        # Drop anything written after the last saved chunk
+        output.truncate(progress['offset'])
+        output.seek(progress['offset'])
+        first = KINDS.index(progress['kind'])
+        for index, kind in enumerate(KINDS[first:], first):
+            cursor = progress['cursor'] if index == first else None
+            exported = 0
+            started = time.time()
+            while True:
+                params = {'kind': kind, 'limit': args.batch_size}
+                if cursor:
+                    params['cursor'] = cursor
+                response = _request('{}/admin/export?{}'.format(
+                    args.url, urllib.urlencode(params)), args.cookie)
+                for line in response:
+                    output.write(line)
+                    exported += 1
+                output.flush()
+                cursor = response.info().getheader('X-Next-Cursor')
+                if not cursor:
+                    break
+                _save_progress(args.path, {'kind': kind,
+                                           'cursor': cursor,
+                                           'offset': output.tell()})
+            sys.stderr.write('{}: {} entities in {:.1f}s\n'.format(
+                kind, exported, time.time() - started))
+            if index + 1 < len(KINDS):
+                _save_progress(args.path, {'kind': KINDS[index + 1],
+                                           'cursor': None,
+                                           'offset': output.tell()})
+    if os.path.exists(_progress_path(args.path)):
+        os.remove(_progress_path(args.path))
+
+
+def import_(args):
+    """Posts the file to the app a chunk of lines at a time."""
+    progress = _load_progress(args.path, args.resume) or {'line': 0}
+    imported = 0
+    started = time.time()
+    with open(args.path) as source:
+        chunk = []
+        for number, line in enumerate(source):
+            if number < progress['line']:
+                continue
+            chunk.append(line)
+            if len(chunk) == args.batch_size:
+                imported += _post_chunk(args, chunk, number + 1)
+                chunk = []
+        if chunk:
+            imported += _post_chunk(args, chunk, number + 1)
+    elapsed = time.time() - started
+    sys.stderr.write('{} entities in {:.1f}s ({:.0f}/s)\n'.format(
+        imported, elapsed, imported / elapsed if elapsed else 0))
+    if os.path.exists(_progress_path(args.path)):
+        os.remove(_progress_path(args.path))
+
+
+def _post_chunk(args, chunk, next_line):
+    response = _request('{}/admin/import'.format(args.url), args.cookie,
+                        ''.join(chunk), 'application/x-ndjson')
+    counts = json.load(response)
+    _save_progress(args.path, {'line': next_line})
+    return sum(counts.values())
+
+
+def load_into_stubs(path, batch_size):
+    """Imports an export file into the active testbed stubs, for running
+    local benchmarks and load tests against exported data. Returns the
+    number of entities imported of each kind.
+    """
+    import bulk
+    from models import User
+    with open(path) as source:
+        counts = bulk.import_lines(source, batch_size)
+    User.rebuild_score_aggregates()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('url', help="the app's base URL")
+    parser.add_argument('path', help='the newline-delimited JSON file')
+    parser.add_argument('--cookie', help="an administrator's login cookie")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='entities per chunk')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run')
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+    if args.command == 'export':
+        export(args)
+    else:
+        import_(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,23 @@
 import logging
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
+import cache
+from instrumentation import instrumented
 
 
+def _bad_request(message):
+    # endpoints is imported only when needed, so that the cron and task
+    # handlers using these helpers don't load the endpoints server
+    import endpoints
+    return endpoints.BadRequestException(message)
+
+
+@instrumented('get_by_urlsafe')
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity corresponding to the urlsafe key. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
-        kind.
+        kind. Entities of CachedModels are read through the entity cache.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
@@ -20,14 +30,17 @@ def get_by_urlsafe(urlsafe, model):
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
+        raise _bad_request('Invalid Key')
     except Exception, e:
         if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
+            raise _bad_request('Invalid Key')
         else:
             raise
 
-    entity = key.get()
+    if issubclass(model, cache.CachedModel):
+        entity = cache.get(key)
+    else:
+        entity = key.get()
     if not entity:
         return None
     if not isinstance(entity, model):
@@ -35,9 +48,27 @@ def get_by_urlsafe(urlsafe, model):
     return entity
 
 
+def fetch_page(query, page_size, cursor=None):
+    """Returns a page of the query results and the urlsafe cursor of the next
+        page, or None if this is the last page.
+    Args:
+        query: The ndb.Query to page through
+        page_size: The maximum number of results to return
+        cursor: The urlsafe cursor returned with the previous page, if any
+    Raises:
+        BadRequestException if the cursor is malformed
+    """
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except Exception:
+        raise _bad_request('Invalid cursor')
+    results, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=start_cursor)
+    if not (more and next_cursor):
+        return results, None
+    return results, next_cursor.urlsafe()
+
+
 def check_complete(board):
     """Checks the board. If all matches have been found, returns True."""
-    for card in board:
-        if not card["cleared"]:
-            return False
-    return True
+    return board.remaining == 0